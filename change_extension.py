@@ -2,7 +2,12 @@
 
 """Change extensions of all matched files in a directory.
 
-Usage: %s ext1 ext2 [dir1 [dir2 [...]]]
+Usage: %s [-r] [-j n] [-journal file] ext1 ext2 [dir1 [dir2 [...]]]
+       %s [-r] [-j n] [-journal file] -rules file [dir1 [dir2 [...]]]
+       %s [-j n] -resume file
+       %s -rollback file
+       %s -benchmark [count]
+       %s -selftest
 
     Where "ext1" is the extension files currently have, "ext2" is the
     extension they should have, and "dir<n>" is a list of directories
@@ -17,6 +22,47 @@ Usage: %s ext1 ext2 [dir1 [dir2 [...]]]
     Note that if either of  "ext1" or "ext2" is non-empty, and does not
     start with a ".", then a "." will be prepended.
 
+    If "-r" is given, then files in the subdirectories of each "dir<n>"
+    (and their subdirectories, and so on) are renamed as well. Symbolic
+    links to directories are not followed.
+
+    If "-rules" is given, then the extensions to change are read from
+    "file" instead, one rule per line, as "ext1 -> ext2" (or just
+    "ext1 ext2"). Blank lines and lines starting with "#" are ignored, and
+    either side of a "->" may be empty. All the rules are applied at once,
+    and if more than one matches a file, the one with the longest "ext1"
+    wins (so ".tar.gz -> .tgz" beats ".gz -> .z" for "fred.tar.gz"). At the
+    end, the number of files renamed by each rule is reported.
+
+    A file is never renamed to the name of something that is already in
+    its directory, or that another file is being renamed to. That is
+    decided from the names read from each directory, before anything is
+    renamed, so changing files and directories while this is running is
+    not a good idea.
+
+    If "-j" is given, then "n" threads do the renaming, which can be much
+    faster on a network filesystem.
+
+    If "-journal" is given, each rename is written to "file" before it is
+    done, and again when it has been done (the file is appended to, as
+    JSON, one rename per line). If a run is interrupted, "-resume file"
+    will do the renames that were planned but not done (without reading
+    the directories again - if the run was interrupted while still reading
+    them, you will be told to run it again), and "-rollback file" will undo
+    the renames that were done, latest first. Both add what they do to the
+    end of "file".
+
+    "-benchmark" makes a directory of "count" (default 1000000) empty
+    files in a temporary directory, times how long the original and
+    current code take to find the files to rename in it (without renaming
+    anything), and then deletes it.
+
+    "-selftest" checks that renaming in threads never lets one file
+    overwrite another, by making (in a temporary directory) files whose
+    renames depend on each other, and slowing down the rename they wait
+    for so that a thread would otherwise get to them first. It also checks
+    that "-resume" won't rename a file onto one that is already there.
+
 Original code by Tibs:
     Tony J. Ibbs (Tibs) <tibs@tibsnjoan.co.uk>
 
@@ -40,6 +86,18 @@ Updated for Python 3, 2022-04-03
 
 import sys
 import os
+import json
+import queue
+import shutil
+import tempfile
+import threading
+import time
+
+
+# How many renames to pass to a thread at once, and how many of those can
+# be waiting for a thread
+BATCH_SIZE = 100
+QUEUE_BATCHES = 4
 
 
 def multiSplitText(aString, anExt):
@@ -61,31 +119,636 @@ def multiSplitText(aString, anExt):
     return root,e
 
 
-def doit(dir,ext1,ext2):
-    """Rename files in "dir" with extension "ext1" to extension "ext2"."""
+def makeMatcher(anExt):
+    """Return a function to split the multi-part extension "anExt" off a name.
+
+    The function returns the root of the name if it ends with "anExt" (in
+    the same sense as multiSplitText), and None if it doesn't. All the work
+    that doesn't depend on the name is done here, once, so most names that
+    don't match are rejected by a single "endswith".
+    """
+
+    if anExt == '':
+        # Only names with no extension at all match
+        def matcher(aString):
+            if '.' in aString.lstrip('.'):
+                return None
+            return aString
+        return matcher
+
+    size = len(anExt)
+    def matcher(aString):
+        if not aString.endswith(anExt):
+            return None
+        root = aString[:-size]
+        # A root of nothing but dots doesn't count (they're a "hidden"
+        # file's leading dots, not the start of an extension)
+        if not root.lstrip('.'):
+            return None
+        return root
+    return matcher
+
+
+class SuffixTrie:
+    """Find the longest of a set of multi-part extensions that a name has.
+
+    The extensions are stored by their dot-separated parts, last part first,
+    so a name is matched by following its own parts back from its end, just
+    as far as some extension does. The cost of that doesn't depend on how
+    many extensions there are.
+    """
+
+    def __init__(self):
+        self.children = {}      # part -> [value or None, children]
+        self.empty = None       # the value for "no extension", if any
+        self.ends = ()          # the last part of each extension, with its dot
+
+    def add(self, anExt, value):
+        """Remember "value" for names with extension "anExt"."""
+        if anExt == '':
+            self.empty = value
+            return
+        parts = anExt[1:].split('.')
+        if '.' + parts[-1] not in self.ends:
+            # A tuple, so that endswith() can check them all at once
+            self.ends += ('.' + parts[-1],)
+        children = self.children
+        for part in reversed(parts):
+            node = children.setdefault(part, [None, {}])
+            children = node[1]
+        node[0] = value
+
+    def match(self, aString):
+        """Return (root, value) for the longest extension "aString" has.
+
+        Returns None if it doesn't have any of them. The root and the
+        extension are split as multiSplitText() would split them.
+        """
+        stripped = aString.lstrip('.')
+        if '.' not in stripped:
+            if self.empty is None:
+                return None
+            return aString, self.empty
+        if not aString.endswith(self.ends):
+            return None
+        parts = stripped.split('.')
+        found = None
+        node = self.children
+        index = len(parts) - 1
+        # parts[0] can't be an extension - it's (the start of) the root
+        while index > 0:
+            child = node.get(parts[index])
+            if child is None:
+                break
+            if child[0] is not None:
+                found = index, child[0]
+            node = child[1]
+            index -= 1
+        if found is None:
+            return None
+        index, value = found
+        lead = len(aString) - len(stripped)
+        return aString[:lead] + '.'.join(parts[:index]), value
+
+
+def readRules(filename):
+    """Read a rules file, as described for "-rules".
+
+    Returns a list of (ext1, ext2), or raises ValueError if a line can't
+    be understood, or two rules have the same "ext1".
+    """
+    rules = []
+    seen = set()
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if '->' in line:
+                words = [word.strip() for word in line.split('->')]
+            else:
+                words = line.split()
+            if len(words) != 2:
+                raise ValueError("%s:%d: expected 'ext1 -> ext2', not %r"%(
+                    filename, number, line))
+            ext1, ext2 = [addDot(word) for word in words]
+            if ext1 in seen:
+                raise ValueError("%s:%d: there is already a rule for %r"%(
+                    filename, number, ext1))
+            seen.add(ext1)
+            rules.append((ext1, ext2))
+    return rules
+
+
+def addDot(anExt):
+    """Make sure an extension starts with "." (unless it's the empty string)."""
+    if len(anExt) != 0 and anExt[0] != ".":
+        anExt = "."+anExt
+    return anExt
+
+
+class Journal:
+    """An append-only record of renames, so they can be resumed or undone.
+
+    Each line is a JSON list, one of:
+
+        ["rename", oldfile, newfile]  - we are about to do this rename
+        ["done", oldfile, newfile]    - and now it's been done
+        ["failed", oldfile, newfile]  - or it couldn't be done
+        ["undone", oldfile, newfile]  - it's been renamed back again
+        ["failed to undo", oldfile, newfile]  - or that couldn't be done
+        ["planned"]                   - every rename has been written down
+
+    The paths are absolute. Each line is flushed as soon as it's written.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.file = open(filename, 'a', encoding='utf-8')
+        # If we were interrupted in the middle of a line, don't add to it
+        with open(filename, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write('\n')
+
+    def write(self, *record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+def readJournal(filename):
+    """Read a journal.
+
+    Returns (renames, state, planned), where "renames" is a list of
+    (oldfile, newfile) in the order they were planned, "state" is a
+    dictionary mapping each of those to the last thing recorded about it
+    ("rename", "done", "failed" or "undone"), and "planned" is true if
+    all the renames for the run were written down.
+    """
+    renames = []
+    state = {}
+    planned = False
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line that was cut short when we were interrupted
+                continue
+            if record == ["planned"]:
+                planned = True
+                continue
+            what, oldfile, newfile = record
+            key = (oldfile, newfile)
+            if what == "rename" and key not in state:
+                renames.append(key)
+            state[key] = what
+    return renames, state, planned
+
+
+class Renamer:
+    """Rename files, and keep count of how many were renamed for each tag.
+
+    If "jobs" is more than 1, then the renames are passed, in batches,
+    through a bounded queue to that many threads, which do them. Otherwise
+    they are done as they are given to us. If "journal" is given, it is
+    told about each rename, and when close() is called, that all the
+    renames have been planned (unless "plan" is false).
+
+    A rename to a name that an earlier rename is moving a file away from
+    has to wait for that rename to happen, or it would overwrite the file.
+    The threads might do the two in either order, so such renames are kept
+    back until close(), when the threads have finished, and then done one
+    by one, in the order they were given to us.
+
+    If "check" is true, then no rename is done if its new name is already
+    there (which we can't otherwise be sure of when resuming a journal,
+    since things may have changed since it was written).
+    """
+
+    def __init__(self, jobs=1, journal=None, plan=True, check=False):
+        self.journal = journal
+        self.plan = plan
+        self.check = check
+        self.counts = {}
+        self.error = None
+        self.lock = threading.Lock()
+        self.batch = []
+        self.later = []
+        self.threads = []
+        if jobs > 1:
+            self.queue = queue.Queue(jobs * QUEUE_BATCHES)
+            for _ in range(jobs):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _rename(self, batch):
+        counts = {}
+        for oldfile, newfile, tag, done, failed, after in batch:
+            if (after or self.check) and os.path.lexists(newfile):
+                # The file we were waiting for didn't get renamed, or
+                # something else has turned up there
+                print("*** Unable to rename %s to %s (already exists)"%(
+                    oldfile, newfile))
+                if self.journal:
+                    self.journal.write(failed, os.path.abspath(oldfile),
+                                       os.path.abspath(newfile))
+                continue
+            try:
+                os.rename(oldfile,newfile)
+            except OSError as e:
+                print("*** Unable to rename %s: %s"%(oldfile, e.strerror))
+                if self.journal:
+                    self.journal.write(failed, os.path.abspath(oldfile),
+                                       os.path.abspath(newfile))
+                continue
+            if self.journal:
+                self.journal.write(done, os.path.abspath(oldfile),
+                                   os.path.abspath(newfile))
+            counts[tag] = counts.get(tag, 0) + 1
+        with self.lock:
+            for tag, count in counts.items():
+                self.counts[tag] = self.counts.get(tag, 0) + count
+
+    def _work(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error:
+                continue            # just empty the queue
+            try:
+                self._rename(batch)
+            except Exception as e:
+                self.error = e
+
+    def rename(self, oldfile, newfile, tag=None, done="done", failed="failed",
+               journaled=False, after=False):
+        """Rename "oldfile" to "newfile", counting it against "tag".
+
+        "done" and "failed" are what to tell the journal when it has been
+        done (or not). The journal is first told the rename is about to
+        happen, unless "journaled" says it already knows.
+
+        "after" should be true if an earlier rename is moving a file away
+        from "newfile". If "newfile" is still there when we come to do the
+        rename, then it isn't done.
+        """
+        if self.journal and not journaled:
+            self.journal.write("rename", os.path.abspath(oldfile),
+                               os.path.abspath(newfile))
+        item = (oldfile, newfile, tag, done, failed, after)
+        if not self.threads:
+            self._rename([item])
+            return
+        if self.error:
+            raise self.error
+        if after:
+            self.later.append(item)
+            return
+        self.batch.append(item)
+        if len(self.batch) >= BATCH_SIZE:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def close(self):
+        """Wait for everything to be renamed."""
+        if self.journal and self.plan:
+            self.journal.write("planned")
+            self.plan = False
+        if self.threads:
+            if self.batch:
+                self.queue.put(self.batch)
+                self.batch = []
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+        if self.error:
+            raise self.error
+        if self.later:
+            self._rename(self.later)
+            self.later = []
+
+
+def planRename(dir, names, vacated, file, newname):
+    """Decide if "file" in "dir" can be renamed to "newname".
+
+    "names" is the set of names in "dir", as they will be after the
+    renames already planned, and "vacated" the set of names those renames
+    are moving files away from - both are updated if the answer is yes.
+    Check if "newname" is in "vacated" first: if it is, the rename must be
+    done after the one that vacates it (see Renamer).
+    """
+    if newname in names:
+        print("*** Unable to rename %s to %s (already exists)"%(
+            os.path.join(dir,file), os.path.join(dir,newname)))
+        return False
+    names.discard(file)
+    names.add(newname)
+    vacated.add(file)
+    vacated.discard(newname)
+    return True
+
+
+def doit(dir,ext1,ext2,matcher=None,renamer=None):
+    """Rename files in "dir" with extension "ext1" to extension "ext2".
+
+    "matcher" should be makeMatcher(ext1), if it has already been made,
+    and "renamer" the Renamer to use, if there is one.
+    """
 
     print("Directory",dir)
 
+    if matcher is None:
+        matcher = makeMatcher(ext1)
+    if renamer is None:
+        renamer = Renamer()
+
     files = os.listdir(dir)
     files.sort()
+    names = set(files)
+    vacated = set()
 
     for file in files:
-        root,ext = multiSplitText(file, ext1)
+        root = matcher(file)
+        if root is None:
+            continue
+        after = root+ext2 in vacated
 
-        if ext == ext1:
+        if planRename(dir, names, vacated, file, root+ext2):
             oldfile = os.path.join(dir,file)
             newfile = os.path.join(dir,root+ext2)
             print("Renaming %s to %s"%(oldfile,newfile))
-
-            if os.path.exists(os.path.join(dir,newfile)):
-                print("*** Unable to rename %s to %s (already exists"%(oldfile, newfile))
+            renamer.rename(oldfile, newfile, after=after)
+
+
+def doTree(dirs, rules, recurse=True, renamer=None):
+    """Apply all the (ext1, ext2) "rules" to the files in "dirs", at once.
+
+    If "recurse" is true, then their subdirectories are included as well -
+    each directory is only read once, however many rules there are. The
+    renaming is done by "renamer", if it is given.
+
+    Returns a list of how many files were renamed by each rule.
+    """
+
+    trie = SuffixTrie()
+    for index, (ext1, ext2) in enumerate(rules):
+        trie.add(ext1, index)
+    if renamer is None:
+        renamer = Renamer()
+
+    for top in dirs:
+        pending = [top]
+        while pending:
+            dir = pending.pop()
+            files = []
+            subdirs = []
+            names = set()
+            vacated = set()
+            try:
+                with os.scandir(dir) as it:
+                    for entry in it:
+                        names.add(entry.name)
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        else:
+                            files.append(entry.name)
+            except OSError as e:
+                print("*** Unable to read %s: %s"%(dir, e.strerror))
+                continue
+
+            announced = False
+            for file in sorted(files):
+                found = trie.match(file)
+                if found is None:
+                    continue
+                if not announced:
+                    print("Directory",dir)
+                    announced = True
+                root, index = found
+                newname = root+rules[index][1]
+                after = newname in vacated
+                if planRename(dir, names, vacated, file, newname):
+                    oldfile = os.path.join(dir,file)
+                    newfile = os.path.join(dir,newname)
+                    print("Renaming %s to %s"%(oldfile,newfile))
+                    renamer.rename(oldfile, newfile, index, after=after)
+
+            if recurse:
+                pending.extend(sorted(subdirs, reverse=True))
+
+    renamer.close()
+    return [renamer.counts.get(index, 0) for index in range(len(rules))]
+
+
+def resume(filename, jobs=1):
+    """Do the renames in journal "filename" that were planned but not done."""
+    renames, state, planned = readJournal(filename)
+    journal = Journal(filename)
+    renamer = Renamer(jobs, journal, plan=False, check=True)
+    moving = set()              # what the renames so far are moving away from
+    try:
+        for oldfile, newfile in renames:
+            if state[(oldfile, newfile)] != "rename":
+                continue
+            if os.path.lexists(oldfile):
+                print("Renaming %s to %s"%(oldfile,newfile))
+                renamer.rename(oldfile, newfile, journaled=True,
+                               after=newfile in moving)
+                moving.add(oldfile)
+            elif os.path.lexists(newfile):
+                # It was renamed, but we stopped before writing that down
+                journal.write("done", oldfile, newfile)
+                renamer.counts[None] = renamer.counts.get(None, 0) + 1
             else:
-                try:
-                    os.rename(oldfile,newfile)
-                except:
-                    print("*** Unable to rename %s"%oldfile)
+                print("*** Unable to rename %s (it is not there)"%oldfile)
+                journal.write("failed", oldfile, newfile)
+        renamer.close()
+    finally:
+        journal.close()
+    print("%d files renamed"%renamer.counts.get(None, 0))
+    if not planned:
+        print("The run was interrupted before all the files to rename had")
+        print("been found - run it again (without -resume) to do the rest")
+
+
+def rollback(filename):
+    """Undo the renames in journal "filename" that were done, latest first."""
+    renames, state, planned = readJournal(filename)
+    journal = Journal(filename)
+    renamer = Renamer(1, journal, plan=False)
+    try:
+        for oldfile, newfile in reversed(renames):
+            what = state[(oldfile, newfile)]
+            if what in ("failed", "undone"):
+                continue
+            if what == "rename" and not os.path.lexists(newfile):
+                continue            # it never happened
+            if os.path.lexists(oldfile):
+                print("*** Unable to rename %s back to %s (already exists)"%(
+                    newfile, oldfile))
+                continue
+            print("Renaming %s back to %s"%(newfile, oldfile))
+            renamer.rename(newfile, oldfile, done="undone",
+                           failed="failed to undo", journaled=True)
+        renamer.close()
+    finally:
+        journal.close()
+    print("%d files renamed back"%renamer.counts.get(None, 0))
+
+
+def report(rules, counts):
+    """Say how many files each rule renamed."""
+    for (ext1, ext2), count in zip(rules, counts):
+        print("%7d %s renamed from %r to %r"%(
+            count, "file" if count == 1 else "files", ext1, ext2))
 
 
+def oldMatches(dir, ext1):
+    """Return the files in "dir" to rename, as the original code found them.
+
+    This is only kept for benchmark() to compare against.
+    """
+    found = []
+    for file in sorted(os.listdir(dir)):
+        root,ext = multiSplitText(file, ext1)
+        if ext == ext1:
+            found.append(file)
+    return found
+
+
+def matches(dir, matcher):
+    """Return the files in "dir" to rename, as doit() finds them."""
+    return [file for file in sorted(os.listdir(dir))
+            if matcher(file) is not None]
+
+
+def benchmark(count=1000000):
+    """Time finding the files to rename in a directory of "count" files."""
+
+    suffixes = (".c", ".h", ".tar.gz", ".gz", ".txt", ".py", ".o", "")
+    top = tempfile.mkdtemp()
+    try:
+        print("Making %d files in %s"%(count, top))
+        for i in range(count):
+            open(os.path.join(top, "f%d%s"%(i, suffixes[i%len(suffixes)])),
+                 "w").close()
+        for ext1 in (".tar.gz", ".txt", ""):
+            for label, finder in (
+                    ("old (splitext)", lambda: oldMatches(top, ext1)),
+                    ("new (endswith)", lambda: matches(top, makeMatcher(ext1)))):
+                start = time.perf_counter()
+                found = finder()
+                print("%-8r %-15s %.3fs, found %d"%(
+                    ext1, label, time.perf_counter()-start, len(found)))
+    finally:
+        shutil.rmtree(top)
+
+
+def selfTest():
+    """Check that renames which depend on each other are done in order,
+    and that resuming a journal doesn't rename onto a file that is there.
+
+    Returns True if all is well.
+    """
+
+    def check(title, files, run, slow, expected):
+        top = tempfile.mkdtemp()
+        realRename = os.rename
+        def slowRename(oldfile, newfile):
+            if os.path.basename(oldfile) == slow:
+                time.sleep(0.5)
+            realRename(oldfile, newfile)
+        try:
+            for name in files:
+                with open(os.path.join(top, name), "w") as f:
+                    f.write(name)
+            os.rename = slowRename
+            try:
+                run(top)
+            finally:
+                os.rename = realRename
+            found = {}
+            for name in os.listdir(top):
+                with open(os.path.join(top, name)) as f:
+                    found[name] = f.read()
+            wanted = dict(expected)
+            for name in files:
+                if name not in wanted.values():
+                    wanted.setdefault(name, name)
+            ok = found == wanted
+            print("%s: %s"%(title, "ok" if ok else "FAILED"))
+            for name in sorted(set(found) | set(wanted)):
+                if found.get(name) != wanted.get(name):
+                    print("    %s should hold %r, but holds %r"%(
+                        name, wanted.get(name), found.get(name)))
+            return ok
+        finally:
+            shutil.rmtree(top)
+
+    # In each case, the first rename in the second batch is onto the name
+    # that the last rename in the first batch moves a file away from
+    others = ["a%02d.b"%i for i in range(BATCH_SIZE-1)]
+    expected = {"a%02d.c"%i: "a%02d.b"%i for i in range(BATCH_SIZE-1)}
+    expected.update({"r.c": "r.b", "r.b": "r.z"})
+    results = [
+        check("Two rules, across a batch boundary", others + ["r.b", "r.z"],
+              lambda top: doTree([top], [(".b", ".c"), (".z", ".b")], False,
+                                 Renamer(2)),
+              "r.b", expected),
+    ]
+    expected = {"a%02d"%i: "a%02d.b"%i for i in range(BATCH_SIZE-1)}
+    expected.update({"x": "x.b", "x.b": "x.b.b"})
+    results.append(
+        check("One rule, onto a name it vacates", others + ["x.b", "x.b.b"],
+              lambda top: doTree([top], [(".b", "")], False, Renamer(8)),
+              "x.b", expected))
+
+    def resumeFrom(records, jobs):
+        def run(top):
+            fd, filename = tempfile.mkstemp()
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    for what, oldfile, newfile in records:
+                        f.write(json.dumps([what, os.path.join(top, oldfile),
+                                            os.path.join(top, newfile)]) + "\n")
+                    f.write(json.dumps(["planned"]) + "\n")
+                resume(filename, jobs)
+            finally:
+                os.remove(filename)
+        return run
+
+    # Neither rename should happen, so nothing should change
+    for jobs in (1, 4):
+        results.append(
+            check("Resume (-j %d), after the rename it waited for failed"%jobs,
+                  ["r.b", "r.z"],
+                  resumeFrom([("rename", "r.b", "r.c"),
+                              ("failed", "r.b", "r.c"),
+                              ("rename", "r.z", "r.b")], jobs),
+                  None, {}))
+        results.append(
+            check("Resume (-j %d), onto a file made since"%jobs,
+                  ["r.y", "r.x"],
+                  resumeFrom([("rename", "r.y", "r.x")], jobs),
+                  None, {}))
+    return all(results)
+
+
 def main():
     """Called from the toplevel."""
 
@@ -95,38 +758,110 @@ def main():
 
     # What arguments do we have?
 
-    if len(arg_list) < 2:
-        scriptName = os.path.split(sys.argv[0])[-1]
-        print(__doc__ % scriptName)
+    if arg_list and arg_list[0] == "-selftest":
+        if not selfTest():
+            sys.exit(1)
         return
 
-    ext1 = arg_list[0]
-    ext2 = arg_list[1]
+    if arg_list and arg_list[0] == "-benchmark":
+        if len(arg_list) > 1 and arg_list[1].isdigit():
+            benchmark(int(arg_list[1]))
+        else:
+            benchmark()
+        return
 
-    # Make sure the extensions start with "."
-    # (unless they're the empty string)
+    recurse = False
+    rules = None
+    jobs = 1
+    journalName = None
+    resumeFrom = None
+    rollbackFrom = None
+    while arg_list and arg_list[0] in ("-r", "-rules", "-j", "-journal",
+                                       "-resume", "-rollback"):
+        word = arg_list.pop(0)
+        if word == "-r":
+            recurse = True
+            continue
+        if not arg_list:
+            print("%s needs an argument"%word)
+            return
+        value = arg_list.pop(0)
+        if word == "-j":
+            try:
+                jobs = int(value)
+            except ValueError:
+                print("-j needs a number of threads")
+                return
+        elif word == "-journal":
+            journalName = value
+        elif word == "-resume":
+            resumeFrom = value
+        elif word == "-rollback":
+            rollbackFrom = value
+        else:
+            try:
+                rules = readRules(value)
+            except (OSError, ValueError) as e:
+                print("*** Unable to read rules: %s"%e)
+                return
+
+    if resumeFrom or rollbackFrom:
+        try:
+            if resumeFrom:
+                resume(resumeFrom, jobs)
+            else:
+                rollback(rollbackFrom)
+        except (OSError, ValueError) as e:
+            print("*** Unable to use journal: %s"%e)
+        return
 
-    if len(ext1) != 0 and ext1[0] != ".":
-        ext1 = "."+ext1
+    if rules is None and len(arg_list) < 2:
+        scriptName = os.path.split(sys.argv[0])[-1]
+        print(__doc__ % ((scriptName,) * 6))
+        return
+
+    if rules is None:
+        # Make sure the extensions start with "."
+        # (unless they're the empty string)
 
-    if len(ext2) != 0 and ext2[0] != ".":
-        ext2 = "."+ext2
+        ext1 = addDot(arg_list[0])
+        ext2 = addDot(arg_list[1])
+        arg_list = arg_list[2:]
 
     # Sort out which directories we want
 
-    dirs = arg_list[2:]
+    dirs = arg_list
     if len(dirs) == 0:
         dirs = ["."]
 
-    # And process each of them
+    # Let's be cautious...
 
     for dir in dirs:
-        # Let's be cautious...
+        if not os.path.isdir(dir):
+            print("%s is not a directory"%dir)
+    dirs = [dir for dir in dirs if os.path.isdir(dir)]
+
+    journal = Journal(journalName) if journalName else None
+    renamer = Renamer(jobs, journal)
 
-        if os.path.isdir(dir):
-            doit(dir,ext1,ext2)
+    try:
+        if rules is not None or recurse:
+            if rules is None:
+                rules = [(ext1, ext2)]
+            counts = doTree(dirs, rules, recurse, renamer)
+            report(rules, counts)
         else:
-            print("%s is not a directory"%dir)
+            # Work out how to recognise the files once, and then process
+            # each of them
+
+            matcher = makeMatcher(ext1)
+
+            for dir in dirs:
+                doit(dir,ext1,ext2,matcher,renamer)
+            renamer.close()
+    finally:
+        if journal:
+            journal.close()
 
 
 # If we're run from the shell, run ourselves
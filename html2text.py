@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
-"""Simple utility to convert HTML to text, using pandoc
+"""Simple utility to convert HTML to text, using pandoc (or not)
 
         usage: html2text [<switches>] infile
                html2text [<switches>] -all [directory [directory ...]]
                html2text -auto [directory [directory ...]]
+               html2text [-r] -list [directory [directory ...]]
+               html2text -benchmark [count]
+               html2text -selftest
 
 Switches:
    -all          all recognised files in the named directory or directories
@@ -15,20 +18,93 @@ Switches:
    -auto         the same as "-all -verbose -delete".
    -compress, -gzip, -z   compress the result with gzip
    -recurse,  -r          recurse through directories, implies -all
+                          (otherwise just the files in each directory
+                          itself are processed).
+   -list         just list the files that would be converted, one per line,
+                 implies -all.
+   -j <n>        convert <n> files at once, each in its own process (the
+                 default is 1, which converts them one after another).
+   -pandoc       use pandoc for .html and .htm files as well.
+   -benchmark    make <count> (default 1000) small HTML files in a temporary
+                 directory, time converting them with and without pandoc,
+                 and then delete them.
+   -selftest     check that finding the files to convert in a nested tree of
+                 directories (made in a temporary directory) gives each file
+                 exactly once, with and without -recurse.
 
 Recognised files are those with suffixes .html, .htm, .doc, .docx and .rtf.
+
+.html and .htm files are converted to reStructuredText by this script itself,
+which is much quicker than starting pandoc for each one, but only copes with
+simple HTML - use -pandoc if the results aren't good enough. .doc files are
+converted by antiword, and .docx and .rtf files by pandoc (after iconv has
+sorted out their encoding).
+
+Files that can't be converted are listed at the end, along with why.
 """
 
 import os
+import re
 import shutil
 import subprocess
 import sys
+import tempfile
+import textwrap
+import time
+import unicodedata
 
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from html.parser import HTMLParser
 from pathlib import Path
-from tempfile import mkdtemp
 
 
-KNOWN_SUFFIXES = ('.html', '.htm', '.doc', '.docx', '.rtf')
+KNOWN_SUFFIXES = frozenset(('.html', '.htm', '.doc', '.docx', '.rtf'))
+
+# What pandoc calls the format of each of those that it reads
+PANDOC_FORMATS = {'.html': 'html', '.htm': 'html', '.docx': 'docx', '.rtf': 'rtf'}
+
+# How many files each worker process may have waiting for it
+QUEUE_PER_JOB = 2
+
+# The suffixes of the files we convert ourselves, unless told to use pandoc
+HTML_SUFFIXES = frozenset(('.html', '.htm'))
+
+# The HTML elements whose content we don't show
+SKIP_ELEMENTS = frozenset(('head', 'script', 'style', 'noscript', 'template'))
+
+# The HTML elements that start (and end) a paragraph of their own
+BLOCK_ELEMENTS = frozenset((
+    'address', 'article', 'aside', 'body', 'center', 'dd', 'div', 'dl', 'dt',
+    'figcaption', 'figure', 'footer', 'form', 'header', 'html', 'main', 'nav',
+    'p', 'section',
+))
+
+# The HTML elements that make up a table (other than <table> itself)
+TABLE_ELEMENTS = frozenset(('caption', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr'))
+
+# How each level of heading is underlined
+HEADING_UNDERLINES = {'h1': '=', 'h2': '-', 'h3': '~', 'h4': '^', 'h5': '"', 'h6': "'"}
+
+# The inline HTML elements we mark up, and how
+INLINE_MARKUP = {'em': '*', 'i': '*', 'strong': '**', 'b': '**', 'code': '``',
+                 'tt': '``', 'kbd': '``', 'samp': '``'}
+
+# The characters in text that reStructuredText would otherwise take as markup
+RST_ESCAPES = str.maketrans({c: '\\' + c for c in '\\*_`|'})
+
+# The starts of a paragraph that reStructuredText would take as some other sort
+# of block - a bullet or enumerated list, a comment or directive, a literal
+# block, a field list or a doctest block
+BLOCK_MARKUP = re.compile(r'(?:[-+*]|\(?(?:[0-9]+|#|[a-zA-Z]|[ivxlcdmIVXLCDM]+)[.)]'
+                          r'|\.\.|::|:[^:\s][^:]*:|>>>)(?:\s|$)')
+
+# What can come just before and just after inline markup: whitespace, these
+# ASCII characters, or non-ASCII punctuation in these Unicode categories
+MARKUP_BEFORE = ('\'"(<[{-/:', ('Pd', 'Po', 'Ps', 'Pi', 'Pf'))
+MARKUP_AFTER = ('\'")>]}-/:\\.,;!?', ('Pd', 'Po', 'Pe', 'Pi', 'Pf'))
+
+# How much of a file to give the HTML parser at once
+HTML_CHUNK_SIZE = 64 * 1024
 
 
 def antiword(infile, textfile):
@@ -58,42 +134,398 @@ def antiword(infile, textfile):
 # <input-file>
 
 
-def iconv(in_file, out_file):
-    """Use iconv to regularise our text encoding.
-    """
-    with open(out_file, 'x') as fd:
-        subprocess.run(
-            [
-                'iconv',
-                '--unicode-subst="?"',
-                '--byte-subst="?"',
-                '-t', 'UTF-8',
-                '-f', 'UTF-8',
-                in_file,
-            ],
-            check=True,
-            stdout=fd,
-        )
-
+def iconv(in_file):
+    """Start iconv regularising our text encoding.
 
-def pandoc(in_file, out_file, text_format='rst'):
-    """Use iconv and pandoc to convert the file.
+    Returns the subprocess.Popen, whose output is available as its 'stdout'.
     """
-    subprocess.run(
+    return subprocess.Popen(
         [
-            'pandoc',
-            '-o', out_file,
-            '-t', text_format,
-            '--fail-if-warnings',
-            '--reference-links',
+            'iconv',
+            '--unicode-subst="?"',
+            '--byte-subst="?"',
+            '-t', 'UTF-8',
+            '-f', 'UTF-8',
             in_file,
         ],
-        check=True,
+        stdout=subprocess.PIPE,
     )
 
 
-def convert_file(infile, temp_dir, force=0, verbose=0, delete=0, compress=0):
+def pandoc(in_file, out_file, text_format='rst', in_format=None, stdin=None):
+    """Use pandoc to convert the file.
+
+    If 'in_file' is None, then pandoc reads 'stdin' instead, and 'in_format'
+    must be given, since it can't be told from the file name.
+    """
+    command = [
+        'pandoc',
+        '-o', out_file,
+        '-t', text_format,
+        '--fail-if-warnings',
+        '--reference-links',
+    ]
+    if in_format:
+        command.extend(['-f', in_format])
+    if in_file is not None:
+        command.append(in_file)
+    subprocess.run(command, check=True, stdin=stdin)
+
+
+def iconv_pandoc(in_file, out_file, in_format, text_format='rst'):
+    """Use iconv and pandoc to convert the file.
+
+    The output of iconv is piped straight into pandoc, so no intermediate
+    file is needed.
+    """
+    process = iconv(in_file)
+    try:
+        pandoc(None, out_file, text_format, in_format, stdin=process.stdout)
+    finally:
+        process.stdout.close()
+        status = process.wait()
+    if status:
+        raise subprocess.CalledProcessError(status, process.args)
+
+
+def _can_touch_markup(char, allowed):
+    """Can 'char' be next to inline markup? 'allowed' is MARKUP_BEFORE/AFTER.
+    """
+    if not char or char.isspace() or char in allowed[0]:
+        return True
+    return not char.isascii() and unicodedata.category(char) in allowed[1]
+
+
+def _fill(text, width, initial_indent, subsequent_indent):
+    """Wrap 'text', but not at the escaped spaces that keep markup apart.
+    """
+    text = textwrap.fill(text.replace('\\ ', '\\\0'), width,
+                         initial_indent=initial_indent,
+                         subsequent_indent=subsequent_indent,
+                         break_long_words=False, break_on_hyphens=False)
+    return text.replace('\0', ' ')
+
+
+def _escape_block(text):
+    """Stop the start of paragraph 'text' being taken as block markup.
+    """
+    if BLOCK_MARKUP.match(text):
+        return '\\' + text
+    return text
+
+
+class HTMLToText(HTMLParser):
+    """Turn HTML into reStructuredText, writing it out as we go.
+
+    Each paragraph is written to 'out' as soon as it ends, wrapped to
+    'width' columns, so only the current paragraph (and the targets of the
+    links seen so far, which are written at the end, as pandoc does with
+    --reference-links) is held in memory. Feed it the HTML a piece at a
+    time, with feed(), and then call close().
+
+    This copes with the sort of HTML we have lots of - headings, paragraphs,
+    lists, links, emphasis, preformatted text and simple tables (which
+    become a "list-table", with each cell's content run together into one
+    paragraph) - and not much more. Anything fancier is better done with
+    pandoc.
+    """
+
+    def __init__(self, out, width=72):
+        super().__init__(convert_charrefs=True)
+        self.out = out
+        self.width = width
+        self.words = []             # the text of the current paragraph
+        self.marks = []             # (tag, index in self.words, href)
+        self.marked = None          # len(self.words) just after inline markup
+        self.skipping = 0           # how deep we are in SKIP_ELEMENTS
+        self.pre = None             # the text of a <pre>, if we're in one
+        self.indent = ''            # the indentation of the current block
+        self.prefix = None          # the bullet for the next paragraph
+        self.lists = []             # [ordered, count, indent] for each list
+        self.quotes = []            # the indent outside each <blockquote>
+        self.targets = {}           # normalised link name -> (name, URL)
+        self.table = None           # the rows of the table we're in, if any
+        self.tables = 0             # how many tables deep we are
+        self.cell = None            # 'th', 'td' or 'caption', if in one
+        self.caption = None         # the caption of the table, if it has one
+        self.started = False
+
+    def _write(self, text):
+        if self.started:
+            self.out.write('\n')
+        self.out.write(text)
+        self.out.write('\n')
+        self.started = True
+
+    def _flush(self, underline=None):
+        text = _escape_block(' '.join(''.join(self.words).split()))
+        self.words = []
+        self.marks = []
+        self.marked = None
+        if not text:
+            return
+        if underline:
+            self._write(f'{self.indent}{text}\n{self.indent}{underline * len(text)}')
+            return
+        prefix = self.prefix or ''
+        self._write(_fill(text, self.width, self.indent + prefix,
+                          self.indent + ' ' * len(prefix)))
+        if self.prefix:
+            # Any more paragraphs in this list item line up with its text
+            self.indent += ' ' * len(self.prefix)
+            self.prefix = None
+
+    def _close_mark(self, tag):
+        # Find the innermost open <tag>, forgetting anything opened inside it
+        for position in range(len(self.marks) - 1, -1, -1):
+            if self.marks[position][0] == tag:
+                break
+        else:
+            return
+        _, start, href = self.marks[position]
+        del self.marks[position:]
+        text = ''.join(self.words[start:])
+        del self.words[start:]
+        inner = ' '.join(text.split())
+        if not inner:
+            self.words.append(text)
+            return
+        before = ' ' if text[:1].isspace() else ''
+        after = ' ' if text[-1:].isspace() else ''
+        if tag == 'a':
+            if not href or href.startswith('#'):
+                self.words.append(before + inner + after)
+                return
+            inner = self._link(inner, href)
+        else:
+            inner = INLINE_MARKUP[tag] + inner + INLINE_MARKUP[tag]
+        if not before:
+            previous = ''
+            for word in reversed(self.words):
+                if word:
+                    previous = word[-1]
+                    break
+            if not _can_touch_markup(previous, MARKUP_BEFORE):
+                # An escaped space keeps the markup apart from the word
+                before = '\\ '
+        self.words.append(before + inner + after)
+        if not after:
+            # handle_data() checks what comes next
+            self.marked = len(self.words)
+
+    def _link(self, text, href):
+        # reStructuredText ignores case and runs of spaces in reference names
+        key = ' '.join(text.lower().split())
+        if self.targets.setdefault(key, (text, href))[1] == href:
+            return f'`{text}`_'
+        # The name is already taken by another URL, so it can't be a reference
+        return f'`{text} <{href}>`__'
+
+    def _end_cell(self):
+        text = _escape_block(' '.join(''.join(self.words).split()))
+        self.words = []
+        self.marks = []
+        self.marked = None
+        if self.cell == 'caption':
+            self.caption = text
+        elif self.cell:
+            if not self.table:
+                self.table.append([])
+            self.table[-1].append((self.cell == 'th', text))
+        self.cell = None
+
+    def _table_tag(self, tag, start):
+        """Deal with a tag inside a table. Returns True if that's all it needs.
+        """
+        if tag == 'table':
+            self.tables += 1 if start else -1
+            if start or self.tables:
+                # We can't do tables in tables, so just run them together
+                self.words.append(' ')
+                return True
+            self._end_cell()
+            self._end_table()
+            return True
+        if self.tables > 1 and tag in TABLE_ELEMENTS:
+            self.words.append(' ')
+            return True
+        if tag in ('tr', 'td', 'th', 'caption'):
+            self._end_cell()
+            if start:
+                if tag == 'tr':
+                    self.table.append([])
+                else:
+                    self.cell = tag
+            return True
+        if tag in TABLE_ELEMENTS or tag in INLINE_MARKUP or tag in ('a', 'img'):
+            return tag in TABLE_ELEMENTS
+        # Anything else just separates words in the cell
+        self.words.append(' ')
+        return True
+
+    def _end_table(self):
+        rows = [row for row in self.table if row]
+        caption = self.caption
+        self.table = self.caption = self.cell = None
+        if not rows:
+            return
+        headers = 0
+        for row in rows:
+            if not all(is_header for is_header, _ in row):
+                break
+            headers += 1
+        columns = max(len(row) for row in rows)
+        lines = [f'{self.indent}.. list-table:: {caption or ""}'.rstrip()]
+        if headers:
+            lines.append(f'{self.indent}   :header-rows: {headers}')
+        lines.append('')
+        for row in rows:
+            cells = [text for _, text in row] + [''] * (columns - len(row))
+            for column, text in enumerate(cells):
+                bullet = '* - ' if column == 0 else '  - '
+                lines.append(_fill(text, self.width,
+                                   self.indent + '   ' + bullet,
+                                   self.indent + '     ' + '  ')
+                             or (self.indent + '   ' + bullet).rstrip())
+        self._write('\n'.join(lines))
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_ELEMENTS:
+            self.skipping += 1
+        if self.skipping:
+            return
+        if self.pre is not None:
+            return
+        if self.table is not None and self._table_tag(tag, True):
+            return
+        if tag in INLINE_MARKUP or tag == 'a':
+            self.marks.append((tag, len(self.words), dict(attrs).get('href')))
+            self.marked = None
+        elif tag == 'img':
+            alt = dict(attrs).get('alt')
+            if alt:
+                self.words.append(f' {alt.translate(RST_ESCAPES)} ')
+        elif tag == 'table':
+            self._flush()
+            self.table = []
+            self.tables = 1
+        elif tag == 'br':
+            self._flush()
+        elif tag in BLOCK_ELEMENTS or tag in HEADING_UNDERLINES:
+            self._flush()
+        elif tag in ('ul', 'ol'):
+            self._flush()
+            self.lists.append([tag == 'ol', 0, self.indent])
+        elif tag == 'li':
+            self._flush()
+            if not self.lists:
+                self.lists.append([False, 0, self.indent])
+            this = self.lists[-1]
+            this[1] += 1
+            self.indent = this[2]
+            self.prefix = f'{this[1]}. ' if this[0] else '- '
+        elif tag == 'blockquote':
+            self._flush()
+            self.quotes.append(self.indent)
+            self.indent += '    '
+        elif tag == 'pre':
+            self._flush()
+            self.pre = []
+        elif tag == 'hr':
+            self._flush()
+            self._write(self.indent + '-' * 14)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in ('img', 'br', 'hr'):
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_ELEMENTS:
+            self.skipping = max(0, self.skipping - 1)
+            return
+        if self.skipping:
+            return
+        if self.pre is not None:
+            if tag == 'pre':
+                self._end_pre()
+            return
+        if self.table is not None and self._table_tag(tag, False):
+            return
+        if tag in INLINE_MARKUP or tag == 'a':
+            self._close_mark(tag)
+        elif tag in HEADING_UNDERLINES:
+            self._flush(HEADING_UNDERLINES[tag])
+        elif tag in BLOCK_ELEMENTS or tag == 'li':
+            self._flush()
+        elif tag in ('ul', 'ol'):
+            self._flush()
+            if self.lists:
+                self.indent = self.lists.pop()[2]
+                self.prefix = None
+        elif tag == 'blockquote':
+            self._flush()
+            if self.quotes:
+                self.indent = self.quotes.pop()
+
+    def _end_pre(self):
+        lines = ''.join(self.pre).expandtabs().strip('\n').split('\n')
+        self.pre = None
+        if any(line.strip() for line in lines):
+            literal = '\n'.join(
+                (self.indent + '    ' + line).rstrip() for line in lines)
+            self._write(f'{self.indent}::\n\n{literal}')
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        if self.pre is not None:
+            self.pre.append(data)
+        else:
+            if not any(INLINE_MARKUP.get(mark[0]) == '``' for mark in self.marks):
+                # (nothing is special in an inline literal)
+                data = data.translate(RST_ESCAPES)
+            if (self.marked == len(self.words)
+                    and not _can_touch_markup(data[:1], MARKUP_AFTER)):
+                data = '\\ ' + data
+            self.words.append(data)
+
+    def close(self):
+        super().close()
+        if self.pre is not None:
+            self._end_pre()
+        if self.table is not None:
+            self._end_cell()
+            self._end_table()
+        self._flush()
+        if self.targets:
+            self._write('\n'.join(f'.. _`{name}`: {href}'
+                                  for name, href in self.targets.values()))
+
+
+def html_to_text(infile, textfile, force=0):
+    """Convert an HTML file to reStructuredText, without any other programs.
+
+    Bytes that aren't valid UTF-8 are replaced, as iconv would do for pandoc.
+    """
+    with open(infile, encoding='utf-8', errors='replace') as fd_in, \
+            open(textfile, 'w' if force else 'x', encoding='utf-8') as fd_out:
+        parser = HTMLToText(fd_out)
+        while True:
+            chunk = fd_in.read(HTML_CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.feed(chunk)
+        parser.close()
+
+
+def convert_file(infile, force=0, verbose=0, delete=0, compress=0, use_pandoc=0):
     """Do the actual work of converting a file.
+
+    HTML files are converted by html_to_text(), unless 'use_pandoc' is true.
+
+    Returns None if all went well (or the file was skipped), or a message
+    saying why it couldn't be converted.
     """
     suffix = infile.suffix
 
@@ -118,21 +550,19 @@ def convert_file(infile, temp_dir, force=0, verbose=0, delete=0, compress=0):
         try:
             antiword(infile, textfile)
         except subprocess.CalledProcessError as exc:
-            print(f'ERR {exc}')
-            return
+            return str(exc)
+    elif suffix in HTML_SUFFIXES and not use_pandoc:
+        html_to_text(infile, textfile, force)
     else:
         # Pandoc doesn't cope well with stray characters that aren't sensibly
         # encoded, so run the file through iconv first
-        temp_file = Path(temp_dir, infile.name)
-        print(f'.. via temporary file {temp_file}')
         try:
-            iconv(infile, temp_file)
-            pandoc(temp_file, textfile)
+            iconv_pandoc(infile, textfile, PANDOC_FORMATS[suffix])
         except subprocess.CalledProcessError as exc:
-            print(f'ERR {exc}')
-            return
-        finally:
-            temp_file.unlink()
+            # Don't leave half a conversion behind
+            if textfile.exists():
+                textfile.unlink()
+            return str(exc)
 
     if compress:
         if verbose:
@@ -148,21 +578,192 @@ def convert_file(infile, temp_dir, force=0, verbose=0, delete=0, compress=0):
         infile.unlink()
 
 
-def process_dir(directory, temp_dir, force=0, verbose=0, delete=0, recurse=0, compress=0):
+BENCHMARK_HTML = """\
+<html><head><title>Page {0}</title><style>p {{ margin: 0 }}</style></head>
+<body>
+<h1>Page {0}</h1>
+<p>This is <em>page</em> {0}, which has a <a href="https://example.com/{0}">link</a>
+and some <strong>strong</strong> text &amp; an entity.</p>
+<ul><li>One item</li><li>Another item, with <code>code</code></li></ul>
+<pre>
+    some preformatted
+    text
+</pre>
+</body></html>
+"""
+
+
+def benchmark(count=1000):
+    """Time converting 'count' small HTML files, with and without pandoc.
+    """
+    top = tempfile.mkdtemp()
+    try:
+        print(f'Making {count} HTML files in {top}')
+        paths = []
+        for n in range(count):
+            path = Path(top, f'page{n}.html')
+            path.write_text(BENCHMARK_HTML.format(n))
+            paths.append(path)
+        for label, use_pandoc in (('html.parser', 0), ('pandoc', 1)):
+            if use_pandoc and not shutil.which('pandoc'):
+                print(f'{label:12} not available')
+                continue
+            failures = 0
+            start = time.perf_counter()
+            for path in paths:
+                if convert_file(path, force=1, use_pandoc=use_pandoc):
+                    failures += 1
+            elapsed = time.perf_counter() - start
+            print(f'{label:12} {elapsed:.3f}s, {elapsed / count * 1000:.3f}ms per file'
+                  + (f', {failures} failed' if failures else ''))
+    finally:
+        shutil.rmtree(top)
+
+
+def self_test(depth=5):
+    """Check that each file in a nested tree is converted exactly once.
+
+    Returns True if all is well.
+    """
+
+    class Counter:
+        """Stands in for a Converter, just counting what it is given."""
+        def __init__(self):
+            self.counts = {}
+
+        def convert(self, infile):
+            self.counts[infile] = self.counts.get(infile, 0) + 1
+
+    top = tempfile.mkdtemp()
+    try:
+        # Each level has two files to convert, one not to, and the next level
+        wanted = []
+        dirpath = Path(top)
+        for level in range(depth):
+            for name in ('page.html', 'report.docx'):
+                wanted.append(dirpath / name)
+            for name in ('page.html', 'report.docx', 'notes.txt'):
+                (dirpath / name).write_text(f'<p>Level {level}</p>')
+            dirpath = dirpath / f'level{level}'
+            dirpath.mkdir()
+        # A link back to the top mustn't be followed
+        os.symlink(top, dirpath / 'loop')
+        results = []
+        for title, recurse, expected in (
+                ('With -recurse', 1, wanted),
+                ('Without -recurse', 0, wanted[:2])):
+            counter = Counter()
+            process_dir(top, counter, verbose=1, recurse=recurse)
+            expected = {path: 1 for path in expected}
+            ok = counter.counts == expected
+            print(f'{title}: {len(counter.counts)} files, '
+                  f'{sum(counter.counts.values())} conversions: '
+                  + ('ok' if ok else 'FAILED'))
+            for path in sorted(set(counter.counts) | set(expected)):
+                if counter.counts.get(path, 0) != expected.get(path, 0):
+                    print(f'    {path} converted {counter.counts.get(path, 0)} '
+                          f'times, not {expected.get(path, 0)}')
+            results.append(ok)
+        return all(results)
+    finally:
+        shutil.rmtree(top)
+
+
+class Converter:
+    """Convert files, either as we are given them, or in a pool of processes.
+
+    If 'jobs' is more than 1, then that many worker processes convert the
+    files, and at most QUEUE_PER_JOB files per worker are waiting to be
+    converted at any time.
+
+    Files that couldn't be converted are remembered, for report().
+    """
+
+    def __init__(self, jobs=1, force=0, verbose=0, delete=0, compress=0, use_pandoc=0):
+        self.options = (force, verbose, delete, compress, use_pandoc)
+        self.failures = []
+        self.pending = {}
+        self.pool = None
+        self.max_pending = jobs * QUEUE_PER_JOB
+        if jobs > 1:
+            self.pool = ProcessPoolExecutor(max_workers=jobs)
+
+    def _failed(self, infile, error):
+        if error:
+            self.failures.append((infile, error))
+
+    def _collect(self, futures):
+        for future in futures:
+            infile = self.pending.pop(future)
+            try:
+                self._failed(infile, future.result())
+            except (subprocess.CalledProcessError, OSError) as exc:
+                self._failed(infile, str(exc))
+
+    def convert(self, infile):
+        """Convert 'infile', now or (with a pool) eventually.
+        """
+        if not self.pool:
+            try:
+                self._failed(infile, convert_file(infile, *self.options))
+            except (subprocess.CalledProcessError, OSError) as exc:
+                self._failed(infile, str(exc))
+            return
+        while len(self.pending) >= self.max_pending:
+            done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+            self._collect(done)
+        future = self.pool.submit(convert_file, infile, *self.options)
+        self.pending[future] = infile
+
+    def close(self):
+        """Wait for all the files to be converted.
+        """
+        if self.pool:
+            done, _ = wait(self.pending)
+            self._collect(done)
+            self.pool.shutdown()
+            self.pool = None
+
+    def report(self):
+        """Report the files that couldn't be converted.
+        """
+        if self.failures:
+            print(f'!! {len(self.failures)} file(s) could not be converted:')
+            for infile, error in self.failures:
+                print(f'ERR {infile}: {error}')
+
+
+def find_files(directory, recurse=0):
+    """Yield the Path of each file in 'directory' that we know how to convert.
+
+    If 'recurse' is true, then the files in its subdirectories (and theirs,
+    and so on) are included, each directory being read just once. Symbolic
+    links to directories are not followed. Each file is yielded as soon as
+    it is found, in the order the filesystem gives them.
+    """
+    pending = [directory]
+    while pending:
+        dirpath = pending.pop()
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recurse:
+                            pending.append(entry.path)
+                    elif os.path.splitext(entry.name)[1] in KNOWN_SUFFIXES:
+                        yield Path(entry.path)
+        except OSError as exc:
+            print(f'!! Cannot read directory {dirpath}: {exc.strerror}')
+
+
+def process_dir(directory, converter, verbose=0, recurse=0):
     """Process the files in a directory.
     """
     if not verbose:
         print(f'++ Directory {directory}')
 
-    for dirpath, dirnames, filenames in os.walk(directory):
-
-        for filename in filenames:
-            path = Path(dirpath, filename)
-            convert_file(path, temp_dir, force, verbose, delete, compress)
-
-        if recurse:
-            for dirname in dirnames:
-                process_dir(Path(dirpath, dirname), temp_dir, force, verbose, delete, recurse, compress)
+    for path in find_files(directory, recurse):
+        converter.convert(path)
 
 
 def main():
@@ -174,6 +775,9 @@ def main():
     delete = False
     recurse = False
     compress = False
+    jobs = 1
+    list_only = False
+    use_pandoc = False
     infiles  = []
 
     args  = sys.argv[1:]
@@ -197,6 +801,27 @@ def main():
             delete = True
         elif word == "-all":
             all_files = True
+        elif word == "-pandoc":
+            use_pandoc = True
+        elif word == "-benchmark":
+            if args and args[0].isdigit():
+                benchmark(int(args.pop(0)))
+            else:
+                benchmark()
+            return
+        elif word == "-selftest":
+            if not self_test():
+                sys.exit(1)
+            return
+        elif word == "-list":
+            list_only = True
+            all_files = True
+        elif word == "-j":
+            try:
+                jobs = int(args.pop(0))
+            except (IndexError, ValueError):
+                print('-j needs a number of processes')
+                return
         elif word == "-auto":
             all_files = True
             delete = True
@@ -204,31 +829,34 @@ def main():
         else:
             infiles.append(word)
 
-    temp_dir = mkdtemp()
+    if list_only:
+        for dirname in infiles or ['.']:
+            for path in find_files(dirname, recurse):
+                print(path)
+        return
 
-    try:
-        if all_files:
-            if not infiles:
-                infiles = ['.']
-            for dirname in infiles:
-                dirpath = Path(dirname)
-                if dirpath.is_dir():
-                    process_dir(dirname, temp_dir,
-                                force=force, verbose=verbose, delete=delete,
-                                recurse=recurse, compress=compress)
-                else:
-                    print(f'!! Ignoring {dirname}, it is not a directory')
-        elif len(infiles) == 1:
-            convert_file(Path(infiles[0]), temp_dir,
-                         force=force, verbose=verbose, delete=delete, compress=compress)
-        elif not len(infiles):
-            print('No filename given to process')
-            print(__doc__)
-        else:
-            print('Too many names given without -all switch')
-            print(__doc__)
-    finally:
-        shutil.rmtree(temp_dir)
+    converter = Converter(jobs, force=force, verbose=verbose, delete=delete,
+                          compress=compress, use_pandoc=use_pandoc)
+
+    if all_files:
+        if not infiles:
+            infiles = ['.']
+        for dirname in infiles:
+            dirpath = Path(dirname)
+            if dirpath.is_dir():
+                process_dir(dirname, converter, verbose=verbose, recurse=recurse)
+            else:
+                print(f'!! Ignoring {dirname}, it is not a directory')
+    elif len(infiles) == 1:
+        converter.convert(Path(infiles[0]))
+    elif not len(infiles):
+        print('No filename given to process')
+        print(__doc__)
+    else:
+        print('Too many names given without -all switch')
+        print(__doc__)
+    converter.close()
+    converter.report()
 
 
 if __name__ == "__main__":
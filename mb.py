@@ -2,39 +2,448 @@
 
 """mb - translate blocks into megabytes, etc.
 
-Usage: mb <number> [<what>]
-   or: mb <filename>
+Usage: mb [--si] [--block-size <n>] <number> [<what>]
+   or: mb [--si] [--block-size <n>] --convert <what> [--to <what>] [<number> ...]
+   or: mb [-j <n>] [--top <n>] [--index <file> [--refresh]] <filename>
+   or: mb [-j <n>] [--index <file> [--refresh]] --batch [<path> ...]
 
 where
     <number>   is an integer to convert
     <what>     is "bytes" (the default) or one of "blocks", "kb",
-               "mb", or "gb", indicating what <number> is counting.
-               The size of a block is assumed to be 512 bytes, because
-               this was written for VMS.
+               "mb", "gb" or "tb" (or "kib", "mib", "gib" or "tib"),
+               indicating what <number> is counting. The size of a block
+               is assumed to be 512 bytes, because this was written for
+               VMS, unless --block-size is given. A kilobyte is 1024
+               bytes, and so on, unless --si is given, in which case "kb"
+               and so on mean 1000 bytes, and so on ("kib" and so on are
+               always 1024 bytes, and so on).
+    --convert  says to convert each <number> given (or, if there aren't
+               any, each number in standard input, which can be a lot of
+               them) from <what> to the unit given by --to (bytes if it
+               isn't given), and output them one per line.
     <filename> is the name of a file, whose size should be reported,
                or a directory, whose contents' size is reported.
+    -j <n>     says how many threads to use to read a directory tree
+               (the default is four per CPU, which suits network and
+               SSD filesystems as well as local disks).
+    --top <n>  says to also list the <n> largest files, and the <n>
+               largest subdirectories (at any depth), in a directory.
+    --index <file>  says to remember what was found in each directory in
+               <file> (which is created if necessary), along with the
+               directory's modification time and inode number. Later runs
+               then only read directories for which those have changed,
+               which just needs one stat of each directory. Note that this
+               means a file changing size, without being added, removed or
+               renamed, won't be noticed. --refresh says to ignore what's
+               already in <file>, and read everything afresh.
+    --batch    says to size each <path> given, or, if there aren't any,
+               each path read from standard input. Those may be separated
+               by newlines or (if there are any NULs) by NULs, as output
+               by "find -print0". Each directory is only read once, however
+               many of the paths it is below.
+
+In batch mode, one line is output for each path, with tab separated fields:
+the size in bytes, Kb, Mb and Gb, the allocated size in bytes, and the path
+itself. If the paths were read NUL separated, the lines end with a NUL as
+well. A path that can't be sized is reported on standard error instead.
+
+The size of a directory is the size of all the files below it (symbolic
+links are counted as themselves, and not followed, and the directories
+themselves aren't counted). A file with more than one hard link is only
+counted once. Both the apparent size (what the files would hold if they
+were read) and the allocated size (how much of the disk they occupy) are
+reported - the latter can be smaller for sparse or compressed files, and is
+normally larger for lots of small files.
 """
 
 import sys
 import os
 import stat
+import heapq
+import functools
+import operator
+import marshal
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+Usage = namedtuple('Usage', 'apparent allocated files dirs unreadable')
+
+# The number of bytes in each unit we know, for powers of 1024 (IEC) and of
+# 1000 (SI). A "block" is handled separately, since its size can be chosen.
+IEC_UNITS = {'byte': 1, 'bytes': 1,
+             'kb': 1024, 'mb': 1024**2, 'gb': 1024**3, 'tb': 1024**4,
+             'kib': 1024, 'mib': 1024**2, 'gib': 1024**3, 'tib': 1024**4}
+SI_UNITS = dict(IEC_UNITS, kb=1000, mb=1000**2, gb=1000**3, tb=1000**4)
+
+DEFAULT_BLOCK_SIZE = 512
+
+# How many numbers to convert at a time, when reading them from a file
+CONVERT_BATCH = 65536
+
+DEFAULT_JOBS = 4 * (os.cpu_count() or 1)
+
+# The start of an index file. Change the number if what we save changes.
+INDEX_MAGIC = b'mb index 1\n'
+
+# Don't remember a directory modified this recently (in nanoseconds), in
+# case it is changed again within the resolution of its modification time.
+RACY_NS = 2 * 1000 * 1000 * 1000
+
+
+class Top(object):
+    """The 'size' largest things we've been told about.
+
+    Only that many are ever remembered, however many we're told about.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.heap = []                  # smallest first
 
+    def add(self, number, what):
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, (number, what))
+        elif number > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (number, what))
 
-def dirsize(path):
-    """Return the size in bytes of the contents of a directory."""
+    def update(self, items):
+        for number, what in items:
+            self.add(number, what)
 
-    os.chdir(path)
-    files = os.listdir(".")
+    def items(self):
+        """Return a list of (number, what), largest first."""
+        return sorted(self.heap, reverse=True)
 
-    number = 0
-    for file in files:
-        filepath = os.path.join(path,file)
-        fstat = os.stat(filepath)
-        number = number + fstat[stat.ST_SIZE]    # add in the file's size
-        if os.path.isdir(filepath):
-            number = number + dirsize(filepath)    # add in the directory contents
 
-    return number
+def scan_dir(path, top=0):
+    """Read a single directory.
+
+    Returns (apparent, allocated, files, links, subdirs, largest), where
+    'apparent' and 'allocated' are the sizes of the files that only have one
+    hard link, 'files' is how many files that is, 'links' is a list of
+    (st_dev, st_ino, apparent, allocated, path) for each file that has more
+    than one hard link, 'subdirs' is a list of the paths of the
+    subdirectories, and 'largest' is a list of (apparent, path) for the 'top'
+    largest files that only have one hard link.
+    """
+    apparent = allocated = files = 0
+    links = []
+    subdirs = []
+    largest = Top(top)
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                fstat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue                # it went away while we were looking
+            if fstat.st_nlink > 1:
+                links.append((fstat.st_dev, fstat.st_ino,
+                              fstat.st_size, fstat.st_blocks * 512,
+                              entry.path))
+            else:
+                apparent += fstat.st_size
+                allocated += fstat.st_blocks * 512
+                files += 1
+                if top:
+                    largest.add(fstat.st_size, entry.path)
+    return apparent, allocated, files, links, subdirs, largest.heap
+
+
+class SizeIndex(object):
+    """Remember what scan_dir() found, so unchanged directories needn't be read.
+
+    The index is a dictionary mapping the absolute path of each directory to
+    ((mtime_ns, inode, device), top, result), where 'result' is what
+    scan_dir(path, top) returned, stored with marshal and compressed with
+    zlib. If 'refresh' is true, then any existing content of the index file
+    is ignored.
+
+    If 'filename' is None, the index is just kept in memory, for the
+    lifetime of the SizeIndex.
+    """
+
+    def __init__(self, filename=None, refresh=False):
+        self.filename = filename
+        self.index = {} if refresh or not filename else self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename, 'rb') as fd:
+                data = fd.read()
+        except FileNotFoundError:
+            return {}
+        if not data.startswith(INDEX_MAGIC):
+            print('Ignoring %s, which is not an mb index (or not the'
+                  ' current version)' % self.filename, file=sys.stderr)
+            return {}
+        try:
+            return marshal.loads(zlib.decompress(data[len(INDEX_MAGIC):]))
+        except (zlib.error, EOFError, ValueError, TypeError):
+            print('Ignoring %s, which is corrupt' % self.filename,
+                  file=sys.stderr)
+            return {}
+
+    def lookup(self, path, top=0):
+        """Return (key, result), where 'result' is None if we must scan 'path'.
+
+        Just the one stat of 'path' itself is needed to decide.
+        """
+        try:
+            dstat = os.stat(path, follow_symlinks=False)
+        except OSError:
+            return None, None           # let scan() find out what's wrong
+        key = (dstat.st_mtime_ns, dstat.st_ino, dstat.st_dev)
+        cached = self.index.get(path)
+        if cached and cached[0] == key and cached[1] >= top:
+            return key, cached[2]
+        return key, None
+
+    def scan(self, path, top=0, key=None):
+        """Return scan_dir(path, top), and remember it (given lookup()'s 'key').
+        """
+        now = time.time_ns()
+        result = scan_dir(path, top)
+        if key and (not self.filename or key[0] < now - RACY_NS):
+            self.index[path] = (key, top, result)
+        else:
+            self.index.pop(path, None)
+        return result
+
+    def close(self):
+        if not self.filename:
+            return
+        data = INDEX_MAGIC + zlib.compress(marshal.dumps(self.index))
+        temp = self.filename + '.tmp'
+        with open(temp, 'wb') as fd:
+            fd.write(data)
+        os.replace(temp, self.filename)
+
+
+def dirsize(path, jobs=DEFAULT_JOBS, largest_files=None, largest_dirs=None,
+            index=None):
+    """Return a Usage for the contents of a directory.
+
+    Subdirectories are read by a pool of 'jobs' threads. Directories that
+    can't be read are counted in Usage.unreadable, and otherwise ignored.
+
+    If 'largest_files' and/or 'largest_dirs' are given, they should be Tops,
+    and are told the (apparent) size of each file and each subdirectory.
+
+    If 'index' is given, it should be a SizeIndex. Directories it already
+    knows about (and that haven't changed) are then not read again, and
+    don't go through the threads at all - everything else is read (and
+    added to the index) as usual. The totals are still added up afresh.
+    """
+
+    files = dirs = unreadable = 0
+    seen = set()                        # (st_dev, st_ino) of hard links
+    top = largest_files.size if largest_files else 0
+    apparent = allocated = 0
+
+    # Each directory we're still working on, with [apparent, allocated,
+    # subdirectories not yet finished, parent path]. When a directory is
+    # finished, its totals are added to its parent's, and it's forgotten.
+    working = {path: [0, 0, 0, None]}
+
+    def finished(dirpath):
+        while True:
+            dir_apparent, dir_allocated, _, parent = working.pop(dirpath)
+            if parent is None:
+                return dir_apparent, dir_allocated
+            if largest_dirs:
+                largest_dirs.add(dir_apparent, dirpath)
+            totals = working[parent]
+            totals[0] += dir_apparent
+            totals[1] += dir_allocated
+            totals[2] -= 1
+            if totals[2]:
+                return None
+            dirpath = parent
+
+    def found(dirpath, result):
+        nonlocal files, dirs, apparent, allocated
+        totals = working[dirpath]
+        dir_apparent, dir_allocated, dir_files, links, subdirs, largest = result
+        files += dir_files
+        for dev, ino, link_apparent, link_allocated, link_path in links:
+            if (dev, ino) not in seen:
+                seen.add((dev, ino))
+                dir_apparent += link_apparent
+                dir_allocated += link_allocated
+                files += 1
+                if largest_files:
+                    largest_files.add(link_apparent, link_path)
+        if largest_files:
+            largest_files.update(largest)
+        totals[0] += dir_apparent
+        totals[1] += dir_allocated
+        totals[2] = len(subdirs)
+        dirs += len(subdirs)
+        for subdir in subdirs:
+            working[subdir] = [0, 0, 0, dirpath]
+        pending.extend(subdirs)
+        if not subdirs:
+            sizes = finished(dirpath)
+            if sizes:
+                apparent, allocated = sizes
+
+    pending = [path]
+    running = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            while pending:
+                dirpath = pending.pop()
+                if index:
+                    key, result = index.lookup(dirpath, top)
+                    if result:
+                        found(dirpath, result)
+                    else:
+                        future = executor.submit(index.scan, dirpath, top, key)
+                        running[future] = dirpath
+                else:
+                    running[executor.submit(scan_dir, dirpath, top)] = dirpath
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                dirpath = running.pop(future)
+                try:
+                    result = future.result()
+                except (PermissionError, FileNotFoundError, NotADirectoryError):
+                    unreadable += 1
+                    result = (0, 0, 0, [], [], [])
+                found(dirpath, result)
+
+    return Usage(apparent, allocated, files, dirs, unreadable)
+
+
+def batch(paths, jobs=DEFAULT_JOBS, index=None, end='\n'):
+    """Output a line giving the size of each path in 'paths'.
+
+    'index' is a SizeIndex, so directories that have already been read (for
+    an earlier path) aren't read again. Each line ends with 'end'.
+    """
+
+    if index is None:
+        index = SizeIndex()
+    for path in paths:
+        path = os.path.abspath(path)
+        try:
+            if os.path.isdir(path):
+                usage = dirsize(path, jobs, index=index)
+                number, allocated = usage.apparent, usage.allocated
+            else:
+                fstat = os.stat(path)
+                number, allocated = fstat.st_size, fstat.st_blocks * 512
+        except OSError as e:
+            print("mb: cannot size %s: %s"%(path, e.strerror), file=sys.stderr)
+            continue
+        sys.stdout.write("%d\t%.3f\t%.3f\t%.3f\t%d\t%s%s"%(
+            number, number / 1024.0, number / (1024*1024.0),
+            number / (1024*1024*1024.0), allocated, path, end))
+
+
+def read_paths(stream):
+    """Return (paths, end) for the paths in 'stream'.
+
+    The paths are NUL separated if there's a NUL, otherwise newline
+    separated, and 'end' is the separator.
+    """
+    data = stream.read()
+    end = '\0' if '\0' in data else '\n'
+    return [path for path in data.split(end) if path], end
+
+
+def unit_size(what, block_size=DEFAULT_BLOCK_SIZE, si=False):
+    """Return the number of bytes in one 'what'.
+
+    Raises ValueError if we don't know what 'what' is.
+    """
+    what = what.lower()
+    if what in ('block', 'blocks'):
+        return block_size
+    try:
+        return (SI_UNITS if si else IEC_UNITS)[what]
+    except KeyError:
+        raise ValueError('Unknown unit %r' % what) from None
+
+
+def convert(numbers, what='bytes', to='bytes', block_size=DEFAULT_BLOCK_SIZE,
+            si=False):
+    """Return a list of 'numbers', counting 'what', converted to count 'to'.
+
+    The conversion is worked out once, and then applied to all the numbers
+    in one go. If it's a whole number of 'to' per 'what', then integers stay
+    integers.
+    """
+    from_size = unit_size(what, block_size, si)
+    to_size = unit_size(to, block_size, si)
+    if from_size % to_size == 0:
+        factor = from_size // to_size
+    else:
+        factor = from_size / to_size
+    if factor == 1:
+        return list(numbers)
+    return list(map(functools.partial(operator.mul, factor), numbers))
+
+
+def read_numbers(stream, batch_size=CONVERT_BATCH):
+    """Yield lists of (up to about 'batch_size') numbers from 'stream'.
+
+    The numbers are separated by whitespace. They are ints if possible,
+    otherwise floats, and raise ValueError if they are neither.
+    """
+    words = []
+    for line in stream:
+        words.extend(line.split())
+        if len(words) >= batch_size:
+            yield to_numbers(words)
+            words = []
+    if words:
+        yield to_numbers(words)
+
+
+def to_numbers(words):
+    """Return a list of the numbers in the strings 'words'."""
+    try:
+        return list(map(int, words))
+    except ValueError:
+        return [int(word) if word.isdigit() else float(word) for word in words]
+
+
+def numberstr(number):
+    """Return 'number' as a string, to three decimal places if need be."""
+    if isinstance(number, int) or number.is_integer():
+        return '%d' % number
+    return '%.3f' % number
+
+
+def sizestr(number):
+    """Return 'number' bytes as a string, in bytes, Kb, Mb and Gb."""
+
+    kb = number / (1024.0)
+    mb = number / (1024*1024.0)
+    gb = number / (1024*1024*1024.0)
+
+    if number == 1:
+        words = ["1 byte"]
+    else:
+        words = ["%s bytes"%number]
+
+    words.append("%.3f Kb"%kb)
+
+    if mb > 0.001:
+        words.append("%.3f Mb"%mb)
+    if gb > 0.001:
+        words.append("%.3f Gb"%gb)
+
+    return " = ".join(words)
 
 
 def main():
@@ -44,6 +453,91 @@ def main():
 
     arg_list = sys.argv[1:]
 
+    jobs = DEFAULT_JOBS
+    top = 0
+    index_file = None
+    refresh = False
+    batching = False
+    block_size = DEFAULT_BLOCK_SIZE
+    si = False
+    convert_from = None
+    convert_to = 'bytes'
+    while arg_list and arg_list[0] in ("-j", "--top", "-top", "--index",
+                                       "-index", "--refresh", "-refresh",
+                                       "--batch", "-batch", "--block-size",
+                                       "-block-size", "--si", "-si",
+                                       "--convert", "-convert", "--to", "-to"):
+        word = arg_list.pop(0)
+        if word in ("--refresh", "-refresh"):
+            refresh = True
+            continue
+        if word in ("--batch", "-batch"):
+            batching = True
+            continue
+        if word in ("--si", "-si"):
+            si = True
+            continue
+        if word in ("--index", "-index", "--convert", "-convert", "--to", "-to"):
+            if not arg_list:
+                print("%s needs an argument"%word)
+                return
+            if word in ("--index", "-index"):
+                index_file = arg_list.pop(0)
+            elif word in ("--convert", "-convert"):
+                convert_from = arg_list.pop(0)
+            else:
+                convert_to = arg_list.pop(0)
+            continue
+        try:
+            value = int(arg_list.pop(0))
+        except (IndexError, ValueError):
+            print(__doc__)
+            return
+        if value < 1:
+            print("%s needs a number greater than zero"%word)
+            return
+        if word == "-j":
+            jobs = value
+        elif word in ("--block-size", "-block-size"):
+            block_size = value
+        else:
+            top = value
+    if refresh and not index_file:
+        print("--refresh only makes sense with --index")
+        return
+
+    if convert_from:
+        try:
+            unit_size(convert_from)
+            unit_size(convert_to)
+            if arg_list:
+                batches = [to_numbers(arg_list)]
+            else:
+                batches = read_numbers(sys.stdin)
+            for numbers in batches:
+                numbers = convert(numbers, convert_from, convert_to,
+                                  block_size, si)
+                sys.stdout.write(''.join(numberstr(number) + '\n'
+                                         for number in numbers))
+        except ValueError as e:
+            print("mb: %s"%e, file=sys.stderr)
+        return
+
+    if batching:
+        if top:
+            print("Cannot use --top with --batch")
+            return
+        if arg_list:
+            paths, end = arg_list, '\n'
+        else:
+            paths, end = read_paths(sys.stdin)
+        index = SizeIndex(index_file, refresh)
+        try:
+            batch(paths, jobs, index, end)
+        finally:
+            index.close()
+        return
+
     # What arguments do we have?
 
     if len(arg_list) == 0:
@@ -59,9 +553,30 @@ def main():
             path = os.path.join(os.getcwd(),path)
         if os.path.exists(path):
             if os.path.isdir(path):
-                number = dirsize(path)
-                print("Directory",path,"contains:")
-                print("     ", end=' ')
+                if top:
+                    largest_files, largest_dirs = Top(top), Top(top)
+                else:
+                    largest_files = largest_dirs = None
+                index = SizeIndex(index_file, refresh) if index_file else None
+                usage = dirsize(path, jobs, largest_files, largest_dirs, index)
+                if index:
+                    index.close()
+                print("Directory",path,"contains",usage.files,"files in",
+                      usage.dirs,"subdirectories:")
+                print("     ", sizestr(usage.apparent))
+                print("      and occupies:")
+                print("     ", sizestr(usage.allocated))
+                if usage.unreadable:
+                    print("      (%d directories could not be read)"%usage.unreadable)
+                if top:
+                    for title, largest in (("files", largest_files),
+                                           ("subdirectories", largest_dirs)):
+                        print()
+                        print("Largest %s in %s:"%(title, path))
+                        for number, what in largest.items():
+                            print("     ", what)
+                            print("         ", sizestr(number))
+                return
             else:
                 fstat  = os.stat(path)        # don't follow links
                 number = fstat[stat.ST_SIZE]    # assume size in bytes
@@ -72,38 +587,13 @@ def main():
             return
 
     if len(arg_list) > 1:
-        what = arg_list[1].lower()
-        if what == "byte" or what == "bytes":
-            pass
-        elif what == "block" or what == "blocks":
-            number = number * 512
-        elif what == "kb":
-            number = number * 1024
-        elif what == "mb":
-            number = number * 1024*1024
-        elif what == "gb":
-            number = number * 1024*1024*1024
-        else:
+        try:
+            number = number * unit_size(arg_list[1], block_size, si)
+        except ValueError:
             print(__doc__)
             return
 
-    kb = number / (1024.0)
-    mb = number / (1024*1024.0)
-    gb = number / (1024*1024*1024.0)
-
-    if number == 1:
-        print("1 byte =", end=' ')
-    else:
-        print(number,"bytes =", end=' ')
-
-    print("%.3f Kb"%kb, end=' ')
-
-    if mb > 0.001:
-        print("= %.3f Mb"%mb, end=' ')
-    if gb > 0.001:
-        print("= %.3f Gb"%gb, end=' ')
-
-    print()
+    print(sizestr(number))
 
 
 # If we're run from the shell, run ourselves
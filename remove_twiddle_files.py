@@ -5,10 +5,16 @@ files) in the given directory (directories) and its (their) subdirectories.
 
 Usage:
     remove_twiddle_files [<switches>] <dir> [<dir> ...]
+    remove_twiddle_files [-n] [-v] [-j <n>] -replay <manifest>
 
 If "-v" is given, announcements will be given for each directory checked.
 If "-n" is given (for "no-effect"), then no files will actually be deleted.
 
+If "-j <n>" is given, files are deleted by <n> threads at once, which can be
+much faster on a network filesystem. In that case each file deleted is only
+reported if "-v" is also given. Either way, the number of files (and bytes)
+deleted, and how long it took, is reported at the end.
+
 If "-swp" is given, ".swp" and ".swo" files will also be deleted.
 If "-dep" is given, ".depend" files will also be deleted.
 If "-all" is given, then all the above extra files to delete are deleted.
@@ -19,15 +25,190 @@ in "-all", because it is not *quite* the same sort of thing.
 If "-pyc" is given, then ".pyc" files will also be deleted. Again, this is
 not included in "-all".
 
+If "-dir" is given, then "__pycache__", ".pytest_cache", ".mypy_cache",
+".ruff_cache" and ".hypothesis" directories will be deleted, along with all
+their content, which is not looked at first. Again, this is not included in
+"-all".
+
 If "-notwiddle" is given, then files ending in "~" will not be deleted.
 
+If "-watch" is given, then once the directories have been processed as
+usual, they are watched (using Linux's inotify) for new files, and any that
+should be deleted are deleted as soon as they appear (or are renamed into
+place). This carries on until interrupted (with Ctrl-C, or SIGTERM). New
+directories are watched as they appear. Beware that this will delete ".swp"
+files (with "-swp") while the editor that made them is still using them.
+
+If "-manifest <file>" is given, then nothing is deleted. Instead, the path,
+size, modification time and inode number of each file (or directory) that
+would have been deleted are written to <file>. Later, "-replay <file>" will
+delete exactly those files, without looking through any directories, except
+for any whose modification time or inode number has changed in the meantime.
+"-n", "-v" and "-j" may be used with "-replay", but the switches saying what
+to delete are ignored.
+
+If "-xdev" is given, then directories on a different filesystem from the
+directory being processed (mount points) are not looked inside.
+
+If "-prune <pattern>" is given, then anything matching <pattern> is left
+alone, and if it is a directory it is not looked inside. Patterns are as in
+a .gitignore file: a pattern without a "/" matches a name anywhere, one with
+a "/" matches a path relative to the directory being processed, a trailing
+"/" means it only matches directories, "*" and "?" don't match "/", and a
+"**" component matches any number of directories (negation with "!" is not
+supported). For instance::
+
+    remove_twiddle_files -prune node_modules/ -prune '/build/*/venv' .
+
+"-prune-file <file>" reads patterns from <file>, one per line, ignoring
+blank lines and lines starting with "#". Both may be given more than once.
+
 Note: does not follow or remove links. Also, does not look inside ".bzr",
-".svn", ".git", ".hg" or ".tox" directories.
+".svn", ".git", ".hg" or ".tox" directories. Directories are processed in
+the order the operating system lists their content, which is not sorted.
+
+"-benchmark [<n>]" makes a tree of <n> files (default 100000) in a
+temporary directory, and reports how long it takes to find the files to
+delete with the old os.listdir() based code, and with the current code.
+Nothing is deleted.
 """
 
 import sys
 import os
+import ctypes
+import ctypes.util
 import errno
+import queue
+import re
+import shutil
+import signal
+import stat
+import struct
+import tempfile
+import threading
+import time
+
+SKIP_DIRS = frozenset((".bzr", ".svn", ".git", ".hg", ".tox"))
+
+# The directories that "-dir" deletes
+JUNK_DIRS = frozenset(("__pycache__", ".pytest_cache", ".mypy_cache",
+                       ".ruff_cache", ".hypothesis"))
+
+# How many files to hand to a deletion thread at a time, and how many such
+# batches may be waiting for each thread
+BATCH_SIZE = 100
+QUEUE_BATCHES = 4
+
+# From <sys/inotify.h>
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_EVENT = struct.Struct("iIII")      # wd, mask, cookie, len
+
+# A manifest is this line, followed by a MANIFEST_RECORD for each file, each
+# followed by the file's path (which is as long as the record says)
+MANIFEST_MAGIC = b"remove_twiddle_files manifest 1\n"
+MANIFEST_RECORD = struct.Struct("<QqQ?I")  # inode, mtime_ns, size, is_dir, len
+
+def glob_regex(pattern):
+    """Return a regular expression for a glob pattern, as used by Prune.
+    """
+    parts = []
+    components = pattern.split("/")
+    for count, component in enumerate(components):
+        if component == "**":
+            if count == len(components)-1:
+                parts.append(".*")
+            else:
+                parts.append("(?:[^/]*/)*")
+            continue
+        i = 0
+        while i < len(component):
+            c = component[i]
+            if c == "*":
+                parts.append("[^/]*")
+            elif c == "?":
+                parts.append("[^/]")
+            elif c == "[" and "]" in component[i+2:]:
+                end = component.index("]", i+2)
+                chars = component[i+1:end].replace("\\", "\\\\")
+                if chars[0] == "!":
+                    chars = "^" + chars[1:]
+                parts.append("[%s]"%chars)
+                i = end
+            else:
+                parts.append(re.escape(c))
+            i += 1
+        if count < len(components)-1:
+            parts.append("/")
+    return "".join(parts)
+
+class Prune(object):
+    """Patterns for what not to look at, as described for "-prune".
+
+    The patterns are compiled once: plain names go into a set, and the
+    other patterns into one regular expression for names and one for paths
+    (relative to the nearest of 'tops'), so the cost of checking something
+    doesn't grow with the number of patterns.
+    """
+
+    def __init__(self, patterns, tops=()):
+        # Longest first, so we find the nearest
+        self.tops = sorted((os.path.join(os.path.abspath(top), "")
+                            for top in tops), key=len, reverse=True)
+        self.names = set()
+        self.dir_names = set()
+        name_regexes = []
+        path_regexes = []
+        for pattern in patterns:
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if not pattern:
+                continue
+            regex = glob_regex(pattern.lstrip("/")) + ("/" if dir_only else "/?")
+            if "/" in pattern:
+                path_regexes.append(regex)
+            elif any(c in pattern for c in "*?["):
+                name_regexes.append(regex)
+            elif dir_only:
+                self.dir_names.add(pattern)
+            else:
+                self.names.add(pattern)
+        self.name_regex = re.compile("|".join(name_regexes)) if name_regexes else None
+        self.path_regex = re.compile("|".join(path_regexes)) if path_regexes else None
+
+    def match(self, what, name, is_dir):
+        """Should 'what' (whose last component is 'name') be left alone?
+
+        'what' must be an absolute path, as find() gives it.
+        """
+        if name in self.names or (is_dir and name in self.dir_names):
+            return True
+        suffix = "/" if is_dir else ""
+        if self.name_regex and self.name_regex.fullmatch(name + suffix):
+            return True
+        if self.path_regex:
+            for top in self.tops:
+                if what.startswith(top):
+                    relpath = what[len(top):] + suffix
+                    return self.path_regex.fullmatch(relpath) is not None
+        return False
+
+def read_patterns(filename):
+    """Return the patterns in a .gitignore style file.
+    """
+    patterns = []
+    with open(filename) as fd:
+        for line in fd:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                patterns.append(line)
+    return patterns
 
 class Remove(object):
     twiddle = True
@@ -35,10 +216,425 @@ class Remove(object):
     dep = False
     tag = False
     pyc = False
+    dir = False
+    prune = None            # a Prune, if there's anything to leave alone
+    xdev = False            # don't look inside other filesystems
+
+    def junk_dirs(self):
+        """Return the set of directory names to remove.
+        """
+        if self.dir:
+            return JUNK_DIRS
+        return frozenset()
+
+    def matcher(self):
+        """Return a function that says if a filename is one to remove.
+
+        All the enabled categories are combined, once, into a set of names
+        and a tuple of suffixes, so checking each file is just a set lookup
+        and a str.endswith().
+        """
+        names = set()
+        suffixes = []
+        if self.twiddle:
+            suffixes.append("~")
+        if self.swp:
+            suffixes.extend((".swp", ".swo"))
+        if self.dep:
+            names.add(".depend")
+        if self.tag:
+            names.add("tags")
+        if self.pyc:
+            suffixes.append(".pyc")
+        names = frozenset(names)
+        suffixes = tuple(suffixes)
+        def match(name):
+            return name in names or name.endswith(suffixes)
+        return match
+
+def find(dirname, match, verbose=True, junk_dirs=frozenset(), visit=None,
+         prune=None, xdev=False):
+    """Yield an os.DirEntry for each file to remove, in and below 'dirname'.
+
+    'match' is a function as returned by Remove.matcher(). Directories
+    named in 'junk_dirs' are also yielded, and not looked inside. If
+    'visit' is given, it is called with the path of each directory, just
+    before that directory is read.
+
+    Anything matched by 'prune' (a Prune) is neither yielded nor looked
+    inside, and if 'xdev' is true, neither is any directory on a different
+    device from 'dirname'.
+
+    'dirname' is made absolute first, so every path found is absolute too,
+    as 'prune' needs.
+    """
+    dirname = os.path.abspath(dirname)
+    if xdev:
+        device = os.stat(dirname).st_dev
+    pending = [dirname]
+    while pending:
+        dirname = pending.pop()
+        if verbose:
+            print("Processing %s"%dirname)
+        if visit:
+            visit(dirname)
+        with os.scandir(dirname) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in SKIP_DIRS and entry.name not in junk_dirs:
+                        continue
+                    if prune and prune.match(entry.path, entry.name, True):
+                        continue
+                    if xdev and entry.stat(follow_symlinks=False).st_dev != device:
+                        if verbose:
+                            print("Not looking in %s, another filesystem"%entry.path)
+                        continue
+                    if entry.name in junk_dirs:
+                        yield entry
+                    else:
+                        pending.append(entry.path)
+                elif match(entry.name):
+                    if not (prune and prune.match(entry.path, entry.name, False)):
+                        yield entry
+
+class Deleter(object):
+    """Delete files, and keep count of what has been deleted.
+
+    If 'jobs' is more than 1, then the files are passed, in batches, through
+    a bounded queue to that many threads, which delete them. Otherwise they
+    are deleted as they are given to us.
+
+    If 'pretend' is true, then nothing is deleted. If 'report' is true, then
+    each file is reported as it is deleted.
+    """
+
+    def __init__(self, jobs=1, pretend=False, report=True):
+        self.pretend = pretend
+        self.report = report
+        self.files = 0
+        self.bytes = 0
+        self.dirs = 0
+        self.start = time.perf_counter()
+        self.error = None
+        self.lock = threading.Lock()
+        self.batch = []
+        self.threads = []
+        if jobs > 1 and not pretend:
+            self.queue = queue.Queue(jobs * QUEUE_BATCHES)
+            for _ in range(jobs):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _delete(self, batch):
+        files = nbytes = dirs = 0
+        for what, size, is_dir in batch:
+            if self.pretend:
+                print("  'Deleting'",what)
+            else:
+                if self.report:
+                    print("  Deleting",what)
+                try:
+                    if is_dir:
+                        shutil.rmtree(what, onerror=self._rmtree_error)
+                    else:
+                        os.remove(what)
+                except OSError as e:
+                    if e.errno == errno.EBUSY:
+                        print("  %s is in use (EBUSY), so not deleting it"%what)
+                        continue
+                    else:
+                        raise
+            if is_dir:
+                dirs += 1
+            else:
+                files += 1
+                nbytes += size
+        with self.lock:
+            self.files += files
+            self.bytes += nbytes
+            self.dirs += dirs
+
+    @staticmethod
+    def _rmtree_error(function, path, exc_info):
+        # Leave anything in use, as we would for a single file, but carry
+        # on removing the rest
+        exc = exc_info[1]
+        if isinstance(exc, OSError) and exc.errno == errno.EBUSY:
+            print("  %s is in use (EBUSY), so not deleting it"%path)
+        elif not (function is os.rmdir and isinstance(exc, OSError) and
+                  exc.errno == errno.ENOTEMPTY):
+            raise exc
+
+    def _work(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error:
+                continue            # just empty the queue
+            try:
+                self._delete(batch)
+            except Exception as e:
+                self.error = e
+
+    def delete(self, what, size, is_dir=False, st=None):
+        """Delete file 'what', which is 'size' bytes long.
+
+        If 'is_dir' is true, then 'what' is a directory, which is deleted
+        along with all its content, and 'size' is ignored. 'st' is the
+        result of os.lstat() on 'what', if we have it, which is only wanted
+        by a Manifest.
+        """
+        if not self.threads:
+            self._delete([(what, size, is_dir)])
+            return
+        if self.error:
+            raise self.error
+        self.batch.append((what, size, is_dir))
+        if len(self.batch) >= BATCH_SIZE:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def flush(self):
+        """Pass on any files we're holding until we have a whole batch.
+        """
+        if self.batch:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def close(self):
+        """Wait for everything to be deleted.
+        """
+        if self.threads:
+            self.flush()
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+        if self.error:
+            raise self.error
 
-def process(dirname, remove, pretend=False, verbose=True):
-    if verbose:
-        print("Processing %s"%dirname)
+    def verb(self):
+        if self.pretend:
+            return "Would have deleted"
+        return "Deleted"
+
+    def summary(self):
+        verb = self.verb()
+        if self.dirs:
+            dirs = " and %d director%s"%(self.dirs,
+                                         "y" if self.dirs == 1 else "ies")
+        else:
+            dirs = ""
+        print("%s %d file%s (%d bytes)%s in %.2fs"%(
+            verb, self.files, "" if self.files == 1 else "s", self.bytes,
+            dirs, time.perf_counter() - self.start))
+
+class Manifest(Deleter):
+    """Record the files that would be deleted, for replay() to delete later.
+
+    This can be used instead of a Deleter, but needs the 'st' argument to
+    delete().
+    """
+
+    def __init__(self, filename):
+        super().__init__(report=False)
+        self.filename = filename
+        self.fd = open(filename, "wb")
+        self.fd.write(MANIFEST_MAGIC)
+
+    def delete(self, what, size, is_dir=False, st=None):
+        path = os.fsencode(os.path.abspath(what))
+        self.fd.write(MANIFEST_RECORD.pack(st.st_ino, st.st_mtime_ns, size,
+                                           is_dir, len(path)))
+        self.fd.write(path)
+        if is_dir:
+            self.dirs += 1
+        else:
+            self.files += 1
+            self.bytes += size
+
+    def close(self):
+        self.fd.close()
+
+    def verb(self):
+        return "Recorded, in %s,"%self.filename
+
+def replay(filename, deleter):
+    """Delete the files recorded in a manifest by a Manifest.
+
+    A file is only deleted if its inode number and modification time are
+    unchanged (so it is still the file that was found). Returns the number
+    of files that weren't deleted because they had changed or gone.
+    """
+    changed = 0
+    with open(filename, "rb") as fd:
+        if fd.readline() != MANIFEST_MAGIC:
+            raise ValueError("%s is not a manifest"%filename)
+        while True:
+            record = fd.read(MANIFEST_RECORD.size)
+            if not record:
+                break
+            inode, mtime_ns, size, is_dir, length = MANIFEST_RECORD.unpack(record)
+            what = os.fsdecode(fd.read(length))
+            try:
+                s = os.lstat(what)
+            except FileNotFoundError:
+                changed += 1
+                continue
+            if s.st_ino != inode or s.st_mtime_ns != mtime_ns or \
+               stat.S_ISDIR(s.st_mode) != is_dir or stat.S_ISLNK(s.st_mode):
+                changed += 1
+                continue
+            deleter.delete(what, size, is_dir)
+    return changed
+
+def process(dirname, remove, pretend=False, verbose=True, deleter=None,
+            visit=None):
+    """Delete the files chosen by 'remove' in and below 'dirname'.
+
+    If 'deleter' is not given, a Deleter is made (and closed) for just this
+    directory, otherwise it is up to the caller to close it. 'visit' is as
+    for find().
+    """
+    if deleter:
+        mine = False
+    else:
+        deleter = Deleter(pretend=pretend)
+        mine = True
+    for entry in find(dirname, remove.matcher(), verbose, remove.junk_dirs(),
+                      visit, remove.prune, remove.xdev):
+        try:
+            s = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            continue                # someone else got there first
+        if entry.is_dir(follow_symlinks=False):
+            deleter.delete(entry.path, 0, is_dir=True, st=s)
+        else:
+            deleter.delete(entry.path, s.st_size, st=s)
+    if mine:
+        deleter.close()
+
+class Watcher(object):
+    """Watch directories for new entries, using Linux's inotify.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = init(IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+        self.paths = {}
+
+    def _raise(self, path=None):
+        e = ctypes.get_errno()
+        if e == errno.ENOSPC:
+            raise OSError(e, "Out of inotify watches (see"
+                          " /proc/sys/fs/inotify/max_user_watches)", path)
+        raise OSError(e, os.strerror(e), path)
+
+    def add(self, dirname):
+        """Watch 'dirname' for new entries.
+
+        Adding a directory we're already watching (for instance, because
+        it has been renamed) just updates its path.
+        """
+        wd = self._add_watch(self.fd, os.fsencode(dirname),
+                             IN_CREATE | IN_MOVED_TO | IN_ONLYDIR | IN_DONT_FOLLOW)
+        if wd < 0:
+            self._raise(dirname)
+        self.paths[wd] = dirname
+
+    def events(self):
+        """Yield (dirname, name, mask) for each new entry, forever.
+
+        If the kernel's queue overflowed, and so some events were lost,
+        yields (None, None, IN_Q_OVERFLOW).
+        """
+        while True:
+            data = os.read(self.fd, 64*1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset+length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    yield None, None, mask
+                elif mask & IN_IGNORED:
+                    # The directory has gone away
+                    self.paths.pop(wd, None)
+                elif wd in self.paths:
+                    yield self.paths[wd], name, mask
+
+    def close(self):
+        os.close(self.fd)
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def watch(directories, remove, pretend=False, verbose=True, deleter=None):
+    """Process 'directories', and then delete new files as they appear.
+
+    This never returns, except by an exception (such as KeyboardInterrupt).
+    The arguments are as for process(), except that 'deleter' is required.
+    """
+    match = remove.matcher()
+    junk_dirs = remove.junk_dirs()
+    watcher = Watcher()
+    try:
+        for dirname in directories:
+            process(dirname, remove, pretend, verbose, deleter, watcher.add)
+        print("Watching for new files")
+        for dirname, name, mask in watcher.events():
+            if dirname is None:
+                print("Some events were missed, so looking at everything again")
+                for dirname in directories:
+                    process(dirname, remove, pretend, verbose, deleter,
+                            watcher.add)
+                continue
+            what = os.path.join(dirname, name)
+            if remove.prune and remove.prune.match(what, name, mask & IN_ISDIR):
+                continue
+            if mask & IN_ISDIR:
+                if name in junk_dirs:
+                    try:
+                        s = os.lstat(what)
+                    except FileNotFoundError:
+                        continue
+                    deleter.delete(what, 0, is_dir=True, st=s)
+                elif name not in SKIP_DIRS:
+                    # Its content may have arrived before we could watch it
+                    try:
+                        process(what, remove, pretend, verbose, deleter,
+                                watcher.add)
+                    except FileNotFoundError:
+                        pass
+            elif match(name):
+                try:
+                    s = os.lstat(what)
+                except FileNotFoundError:
+                    continue
+                if not stat.S_ISLNK(s.st_mode):
+                    deleter.delete(what, s.st_size, st=s)
+            deleter.flush()
+    finally:
+        watcher.close()
+
+def old_find(dirname, remove):
+    """Yield the path of each file to remove, as the original code did.
+
+    This is only kept for benchmark() to compare against.
+    """
     files = os.listdir(dirname)
     files.sort()
     for name in files:
@@ -47,29 +643,52 @@ def process(dirname, remove, pretend=False, verbose=True):
             continue
         if os.path.isdir(what):
             if name not in (".bzr", ".svn", ".git", ".hg", ".tox"):
-                process(what, remove, pretend, verbose)
+                yield from old_find(what, remove)
         else:
             if (remove.twiddle and name[-1] == "~") or \
                (remove.swp and name[-4:] in (".swp", ".swo")) or \
                (remove.dep and name == ".depend") or \
                (remove.tag and name == "tags") or \
                (remove.pyc and name.endswith(".pyc")):
-                if pretend:
-                    print("  'Deleting'",what)
-                else:
-                    print("  Deleting",what)
-                    try:
-                        os.remove(what)
-                    except OSError as e:
-                        if e.errno == errno.EBUSY:
-                            print("  ...which is in use (EBUSY), so not deleting it")
-                        else:
-                            raise
+                yield what
+
+def make_tree(top, count):
+    """Make a tree of 'count' (empty) files in 'top', for benchmark().
+    """
+    suffixes = (".c", ".h", ".py", ".pyc", ".c~", ".swp", ".txt", "")
+    per_dir = 100
+    for n in range(0, count, per_dir):
+        dirname = os.path.join(top, "d%d"%(n//10000), "d%d"%(n//per_dir))
+        os.makedirs(dirname, exist_ok=True)
+        for i in range(n, min(n+per_dir, count)):
+            name = "f%d%s"%(i, suffixes[i%len(suffixes)])
+            open(os.path.join(dirname,name), "w").close()
+
+def benchmark(count=100000):
+    remove = Remove()
+    remove.swp = remove.dep = remove.tag = remove.pyc = True
+    top = tempfile.mkdtemp()
+    try:
+        print("Making %d files in %s"%(count, top))
+        make_tree(top, count)
+        for label, finder in (
+                ("old (listdir)", lambda: list(old_find(top, remove))),
+                ("new (scandir)", lambda: [e.path for e in find(top, remove.matcher(), False)])):
+            start = time.perf_counter()
+            found = finder()
+            print("%-14s %.3fs, found %d"%(label, time.perf_counter()-start, len(found)))
+    finally:
+        shutil.rmtree(top)
 
 def main():
     pretend = False
     remove = Remove()
     verbose = False
+    watching = False
+    manifest = None
+    replay_from = None
+    jobs = 1
+    prune = []
     directories = []
     arg_list = sys.argv[1:]
     if len(arg_list) < 1:
@@ -94,14 +713,78 @@ def main():
             remove.tag = True
         elif word == "-pyc":
             remove.pyc = True
+        elif word == "-dir":
+            remove.dir = True
         elif word == "-all":
             remove.swp = True
             remove.dep = True
         elif word == "-v":
             verbose = True
+        elif word == "-watch":
+            watching = True
+        elif word == "-xdev":
+            remove.xdev = True
+        elif word in ("-prune", "-prune-file"):
+            try:
+                value = arg_list.pop(0)
+            except IndexError:
+                print("%s needs an argument"%word)
+                return
+            if word == "-prune":
+                prune.append(value)
+            else:
+                try:
+                    prune.extend(read_patterns(value))
+                except OSError as e:
+                    print("!!! Cannot read %s: %s"%(value, e))
+                    return
+        elif word in ("-manifest", "-replay"):
+            try:
+                filename = arg_list.pop(0)
+            except IndexError:
+                print("%s needs a filename"%word)
+                return
+            if word == "-manifest":
+                manifest = filename
+            else:
+                replay_from = filename
+        elif word == "-j":
+            try:
+                jobs = int(arg_list.pop(0))
+            except (IndexError, ValueError):
+                print("-j needs a number of threads")
+                return
+        elif word == "-benchmark":
+            if arg_list and arg_list[0].isdigit():
+                benchmark(int(arg_list.pop(0)))
+            else:
+                benchmark()
+            return
         else:
             directories.append(word)
 
+    if replay_from:
+        if directories or watching or manifest:
+            print("-replay cannot be used with directories, -watch or -manifest")
+            return
+        deleter = Deleter(jobs, pretend, report=(jobs == 1 or verbose))
+        try:
+            changed = replay(replay_from, deleter)
+        except ValueError as e:
+            print("!!! %s"%e)
+            return
+        finally:
+            deleter.close()
+        deleter.summary()
+        if changed:
+            print("%d file%s had changed or gone, and so were left alone"%(
+                changed, "" if changed == 1 else "s"))
+        return
+
+    if manifest and watching:
+        print("-manifest cannot be used with -watch")
+        return
+
     if not directories:
         print("No directory specified")
         print()
@@ -114,16 +797,42 @@ def main():
     if remove.dep: print(".depend files,", end= ' ')
     if remove.tag: print("tags files", end= ' ')
     if remove.pyc: print(".pyc files", end=' ')
+    if remove.dir: print("cache directories", end=' ')
     print("in %s"%(', '.join(directories)))
 
+    valid = []
     for dirname in directories:
         if os.path.isdir(dirname):
-            process(dirname, remove, pretend, verbose)
+            valid.append(dirname)
         else:
             if os.path.exists(dirname):
                 print("!!! '%s' is not a directory"%dirname)
             else:
                 print("!!! Directory '%s' does not exist"%dirname)
 
+    if prune:
+        remove.prune = Prune(prune, valid)
+
+    if manifest:
+        deleter = Manifest(manifest)
+    else:
+        deleter = Deleter(jobs, pretend, report=(jobs == 1 or verbose))
+    try:
+        if watching:
+            signal.signal(signal.SIGTERM, interrupt)
+            watch(valid, remove, pretend, verbose, deleter)
+        else:
+            for dirname in valid:
+                process(dirname, remove, pretend, verbose, deleter)
+    except KeyboardInterrupt:
+        print("Interrupted")
+    except OSError as e:
+        if not watching:
+            raise
+        print("!!! Cannot watch for new files: %s"%e)
+    finally:
+        deleter.close()
+    deleter.summary()
+
 if __name__ == "__main__":
     main()
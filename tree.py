@@ -1,14 +1,29 @@
 #! /usr/bin/env python3
 
-"""Usage: tree.py [-f[old] <dir>] [-a[scii]] [<directory>]
+"""Usage: tree.py [-f[old] <pattern>] [-nofold <pattern>] [-fold-file <file>]
+               [-i[gnore] <pattern>] [-noignore <pattern>] [-ignore-file <file>]
+               [-a[scii]] [-d] [-L <depth> [-summarise]] [-j <n>] [-U | -spill <n>]
+               [-cache <file> [-refresh]] [-json | -0] [-stats] [<directory>]
 
-Directories named by '-fold' ('-f') will not have their content shown
-You may nominate multiple "folded" directories, but each needs to be
-preceded by the switch. For instance::
+Directories matching a pattern given by '-fold' ('-f') will not have their
+content shown. You may give multiple patterns, but each needs to be preceded
+by the switch. For instance::
 
-    tree.py -f .git -f .weld fromble
+    tree.py -f .weld -f 'build-*' fromble
 
-(but actually .git directories are currently always folded - this is a hack)
+Similarly, anything matching a pattern given by '-ignore' ('-i') will not be
+shown at all. Neither folded nor ignored directories are ever read.
+
+Patterns are as in a .gitignore file - a pattern without a '/' matches a
+name anywhere in the tree, one with a '/' matches a path relative to
+<directory>, a trailing '/' means it only matches directories, '*' and '?'
+don't match '/' but '**' does, and a leading '!' means anything that matches
+that pattern is excluded. '-fold-file' and '-ignore-file' read patterns from a
+file in that format (one per line, ignoring blank lines and '#' comments).
+
+By default '.git/' is folded, and '__pycache__/' is ignored. Use '-nofold .git/'
+or '-noignore __pycache__/' to stop that. '--fold' and '--ignore' are also
+accepted.
 
 If you specify '-ascii' ('-a') then "normal" characters will be used to show
 the tree structure, instead of IBM437 characters (this is similar to the "real"
@@ -16,27 +31,151 @@ tree's '--charset=ASCII')
 
 If you specify -d then only directories will be shown.
 
-__pycache__ directories are not shown (this is a hack)
+If you specify '-L <depth>' then only that many levels of the tree will be
+shown ('-L 1' just shows the content of <directory>). If you also specify
+'-summarise' then each directory at the last level will be followed by the
+number of files (of any sort except directories) within it, at any depth,
+and their total size. Those are found by a quick scan that doesn't follow
+links, sort anything, or stat directories.
+
+If you specify '-j <n>' then directories will be listed by <n> threads at
+once, ahead of when they are needed. This can be a lot faster on network
+filesystems, where each listing has to wait on the server. The output is
+exactly the same as without '-j'.
+
+Normally each directory is read completely, and sorted, before any of it is
+output. For a directory with millions of entries that takes a lot of memory,
+and a while before anything appears. So:
+
+* If you specify '-U' ('-unsorted') then entries are output in the order the
+  operating system gives them, as they are read.
+* If you specify '-spill <n>' then entries are still sorted, but at most <n>
+  of them are held in memory for each directory. Larger directories are
+  sorted in runs of <n> entries, which are written to temporary files and
+  then merged (no more than 64 at a time, so very large directories are
+  merged in stages, through longer runs).
+
+Neither can be used with '-j'.
+
+If you specify '-cache <file>' then the listing of each directory is saved in
+<file> (which is created if necessary), along with the directory's
+modification time and inode number. On later runs, a directory for which
+those have not changed is not listed again - its entries are taken from
+<file> instead, which just needs one stat of the directory itself. Note that
+this means changes that don't alter the directory, such as a file becoming
+executable, won't be noticed. If you also specify '-refresh' then the
+existing content of <file> is ignored, and everything is listed afresh.
+Simply deleting <file> has the same effect. '-cache' cannot be used with
+'-j', '-unsorted' or '-spill'.
+
+If you specify '-json' then, instead of a tree, one JSON object is output per
+line for each file and directory, with keys:
+
+    path    the absolute path
+    type    "file", "dir" or "link"
+    flags   what would be shown after the name in the tree (so "/", "/...",
+            "*", "@ -> <target>", and so on)
+    size    the size in bytes (null for a directory)
+    files   for a directory, or a link to one, the number of non-directory
+            entries within it (at any depth)
+    bytes   and their total size in bytes
+
+The totals are worked out as the tree is walked, so each directory is output
+after its contents. A folded directory has null totals. The totals for a
+directory include a link within it (counted as a file of the link's size),
+but not the content of the directory it links to - so they don't count
+anything twice.
+
+If you specify '-0' ('-nul') then the same information is output, but as
+six fields per entry, in the order above, each ending with a NUL character.
+A null value is output as an empty field.
+
+If you specify '-stats' ('--stats') then, once the tree has been output, a
+summary of how many directory listings and stat calls were made will be
+written to stderr, together with the number of such calls per entry. Note
+that os.path.realpath() on a symbolic link is counted as one call, although
+it may make several.
+
+Links to directories are followed, except for those that lead back to a
+directory whose contents are already being shown.
 """
 
-# TODO: ignore __pycache__ directories by default
-#           -ignore <dir>       -- defaults to -ignore __pycache__
-#           -noignore <dir>     -- use -noignore __pycache__ to see them
-# TODO: fold .git directories by default - so need to rethink how folding works
-#           -fold <dir>         -- defaults to -fold .git
-#           -nofold <dir>       -- use -nofold .git to see their content
 # TODO: use Python3 facilities instead of older Python2 mechanisms
 # TODO: use argparse because the command line is now getting complicated,
 #       and also because it should allow -f to take a *list* of names,
 #       as well as allowing it to be specified more than once.
 
 import sys
+import heapq
+import json
+import marshal
 import os
+import queue
+import re
 import stat
+import threading
+import time
+import zlib
+
+from collections import namedtuple
+from concurrent.futures import Future
+from itertools import islice
+from tempfile import TemporaryFile
 
 INDENT = '    '
 
-DEFAULT_IGNORE = ['__pycache__']
+# The start of a cache file. Change the number if what we save changes.
+CACHE_MAGIC = b'tree.py cache 2\n'
+
+# Don't cache a directory modified this recently (in nanoseconds), in case
+# it is modified again within the same tick of its modification time
+RACY_NS = 2 * 1000000000
+
+DEFAULT_IGNORE = ['__pycache__/']
+
+DEFAULT_FOLD = ['.git/']
+
+EXECUTABLE = stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+
+# The most runs sort_items() merges at once (each needs an open file)
+MERGE_WIDTH = 64
+
+# What we remember about each entry in a directory. 'is_dir' is True if the
+# entry is a directory or a link to one (i.e., if we would recurse into it),
+# and 'flags' is what filestr() would append to its name (without any '...'
+# for a folded directory, which depends on the command line). For a link,
+# 'target' is the real path of what it links to, and otherwise it is None.
+# 'size' is the size of the entry itself (not following links), or None for
+# a directory.
+Item = namedtuple('Item', 'name is_dir flags target size')
+
+
+class Stats:
+    """Count the system calls made while walking a tree.
+
+    We count one call for each directory listed, and one for each stat
+    (or equivalent) made on an entry. We do not count the calls that
+    os.DirEntry makes on our behalf when the operating system didn't tell
+    us an entry's type - those are rare on local filesystems.
+    """
+
+    def __init__(self):
+        self.listings = 0
+        self.entries = 0
+        self.stats = 0
+
+    def add(self, other):
+        self.listings += other.listings
+        self.entries += other.entries
+        self.stats += other.stats
+
+    def report(self, file=sys.stderr):
+        syscalls = self.listings + self.stats
+        print('%d entries: %d listings + %d stats = %d syscalls,'
+              ' %.3f per entry' % (
+                  self.entries, self.listings, self.stats,
+                  syscalls, syscalls / max(self.entries, 1)),
+              file=file)
 
 
 def filestr(path, filename, fold_dirs=None):
@@ -77,7 +216,579 @@ def filestr(path, filename, fold_dirs=None):
     return '%s%s' % (filename, ''.join(flags))
 
 
-def tree(dirpath, padding='', fold_dirs=None, just_ascii=False, only_dirs=False):
+def describe(entry, stats=None):
+    """Return an Item describing an os.scandir() entry.
+
+    This does the same job as filestr(), but uses the information that
+    the os.DirEntry already has (its type, and its cached stat result), so
+    that we normally make at most one system call per entry. The same
+    information is then used to decide whether to recurse.
+    """
+    calls = 0
+    far = None
+    size = None
+    if entry.is_symlink():
+        far = os.path.realpath(entry.path)
+        rel = os.path.relpath(far, os.path.dirname(entry.path))
+        try:
+            is_dir = entry.is_dir()     # follows the link, so one stat
+        except OSError:
+            is_dir = False              # as os.path.isdir() would say
+        size = entry.stat(follow_symlinks=False).st_size
+        calls += 3
+        flags = '@ -> %s%s' % (rel, '/' if is_dir else '')
+    elif entry.is_dir(follow_symlinks=False):
+        is_dir = True
+        flags = '/'
+    else:
+        is_dir = False
+        s = entry.stat(follow_symlinks=False)
+        calls += 1
+        flags = '*' if s.st_mode & EXECUTABLE else ''
+        size = s.st_size
+    if stats:
+        stats.entries += 1
+        stats.stats += calls
+    return Item(entry.name, is_dir, flags, far, size)
+
+
+def iter_dir(dirpath, stats=None):
+    """Yield an Item for each entry in 'dirpath', in the order they are read.
+    """
+    if stats:
+        stats.listings += 1
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            yield describe(entry, stats)
+
+
+def summarise(dirpath, ignore=None, stats=None):
+    """Return (files, nbytes) for everything below 'dirpath'.
+
+    'files' counts everything that is not a directory (including links),
+    and 'nbytes' is their total size. This is much cheaper than listing
+    the directories with list_dir(), since links are not followed and
+    nothing is sorted, so each directory is one listing and each file
+    one stat.
+    """
+    files = nbytes = 0
+    pending = [dirpath]
+    while pending:
+        with os.scandir(pending.pop()) as it:
+            if stats:
+                stats.listings += 1
+            for entry in it:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if ignore and ignore.match(entry.path, entry.name, is_dir):
+                    continue
+                if stats:
+                    stats.entries += 1
+                if is_dir:
+                    pending.append(entry.path)
+                else:
+                    files += 1
+                    nbytes += entry.stat(follow_symlinks=False).st_size
+                    if stats:
+                        stats.stats += 1
+    return files, nbytes
+
+
+def list_dir(dirpath, stats=None):
+    """Return a list of Items for the entries in 'dirpath', sorted by name.
+    """
+    items = list(iter_dir(dirpath, stats))
+    items.sort()
+    return items
+
+
+def _read_run(fd):
+    fd.seek(0)
+    while True:
+        try:
+            yield Item._make(marshal.load(fd))
+        except EOFError:
+            return
+
+
+def _write_run(items):
+    fd = TemporaryFile()
+    try:
+        for item in items:
+            marshal.dump(tuple(item), fd)
+    except BaseException:
+        fd.close()
+        raise
+    return fd
+
+
+def _merge_runs(runs):
+    """Merge the (sorted) temporary files 'runs' into a new one.
+    """
+    return _write_run(heapq.merge(*[_read_run(fd) for fd in runs]))
+
+
+def sort_items(items, run_size):
+    """Yield 'items' sorted by name, holding at most 'run_size' of them at once.
+
+    If there are more than that, each run of 'run_size' items is sorted and
+    written to a temporary file, and then the runs are merged. So that we
+    don't need too many files open at once, whenever there are MERGE_WIDTH
+    runs of the same length, they are merged into one longer run, and at the
+    end, the shortest runs are merged until there are no more than
+    MERGE_WIDTH left to merge for the output.
+    """
+    levels = []     # levels[n] holds the runs made from MERGE_WIDTH**n runs
+    try:
+        items = iter(items)
+        while True:
+            run = list(islice(items, run_size))
+            if not run:
+                break
+            run.sort()
+            if not levels and len(run) < run_size:
+                # It all fitted, so there's no need to spill it
+                yield from run
+                return
+            fd = _write_run(run)
+            for runs in levels:
+                runs.append(fd)
+                if len(runs) < MERGE_WIDTH:
+                    break
+                fd = _merge_runs(runs)
+                for old in runs:
+                    old.close()
+                runs.clear()
+            else:
+                levels.append([fd])
+        runs = [fd for runs in levels for fd in runs]
+        levels = [runs]
+        while len(runs) > MERGE_WIDTH:
+            fd = _merge_runs(runs[:MERGE_WIDTH])
+            for old in runs[:MERGE_WIDTH]:
+                old.close()
+            runs[:MERGE_WIDTH] = []
+            runs.append(fd)
+        yield from heapq.merge(*[_read_run(fd) for fd in runs])
+    finally:
+        for runs in levels:
+            for fd in runs:
+                fd.close()
+
+
+def lookahead(items):
+    """Yield (item, is_last) for each of 'items'.
+
+    This lets us know which is the last item without needing a list.
+    """
+    items = iter(items)
+    try:
+        previous = next(items)
+    except StopIteration:
+        return
+    for item in items:
+        yield previous, False
+        previous = item
+    yield previous, True
+
+
+def with_paths(dirpath, items):
+    """Yield (count, item, path) for each of 'items' in 'dirpath'.
+    """
+    for count, item in enumerate(items):
+        yield count, item, os.path.join(dirpath, item.name)
+
+
+class Lister:
+    """List directories one at a time, as they are asked for.
+    """
+
+    def __init__(self, stats=None):
+        self.stats = stats
+
+    def prefetch(self, wanted):
+        """Say which directories we will be asking for.
+
+        'wanted' is an iterable of (position, dirpath), where 'position' is
+        a tuple giving the directory's place in the output, such that
+        sorting by position gives the order in which they will be listed.
+        It is worked out from what list() returned, so a Lister that
+        returns an iterator must not use it.
+        """
+        pass
+
+    def list(self, dirpath):
+        """Return an iterable of the Items in 'dirpath', sorted by name.
+        """
+        return list_dir(dirpath, self.stats)
+
+    def summarise(self, dirpath, ignore=None):
+        """Return (files, nbytes) for 'dirpath', as summarise() does.
+        """
+        return summarise(dirpath, ignore, self.stats)
+
+    def close(self):
+        pass
+
+
+class StreamingLister(Lister):
+    """List directories without holding all their entries in memory.
+
+    If 'run_size' is None, the Items are returned in the order they are
+    read, otherwise they are sorted as by sort_items().
+    """
+
+    def __init__(self, run_size=None, stats=None):
+        super().__init__(stats)
+        self.run_size = run_size
+
+    def list(self, dirpath):
+        items = iter_dir(dirpath, self.stats)
+        if self.run_size:
+            return sort_items(items, self.run_size)
+        return items
+
+
+class CachingLister(Lister):
+    """List directories, reusing the listings saved in a cache file.
+
+    The cache is a dictionary mapping the absolute path of each directory
+    to ((mtime_ns, inode), items), where 'items' is a list of Item tuples,
+    stored with marshal and compressed with zlib. If 'refresh' is true,
+    then any existing content of the cache file is ignored.
+    """
+
+    def __init__(self, filename, refresh=False, stats=None):
+        super().__init__(stats)
+        self.filename = filename
+        self.cache = {} if refresh else self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename, 'rb') as fd:
+                data = fd.read()
+        except FileNotFoundError:
+            return {}
+        if not data.startswith(CACHE_MAGIC):
+            print('Ignoring %s, which is not a tree.py cache (or not the'
+                  ' current version)' % self.filename, file=sys.stderr)
+            return {}
+        try:
+            return marshal.loads(zlib.decompress(data[len(CACHE_MAGIC):]))
+        except (zlib.error, EOFError, ValueError, TypeError):
+            print('Ignoring %s, which is corrupt' % self.filename,
+                  file=sys.stderr)
+            return {}
+
+    def list(self, dirpath):
+        s = os.stat(dirpath)
+        if self.stats:
+            self.stats.stats += 1
+        key = (s.st_mtime_ns, s.st_ino)
+        cached = self.cache.get(dirpath)
+        if cached and cached[0] == key:
+            if self.stats:
+                self.stats.entries += len(cached[1])
+            return [Item._make(item) for item in cached[1]]
+
+        now = time.time_ns()
+        items = list_dir(dirpath, self.stats)
+        if s.st_mtime_ns < now - RACY_NS:
+            self.cache[dirpath] = (key, [tuple(item) for item in items])
+        else:
+            self.cache.pop(dirpath, None)
+        return items
+
+    def summarise(self, dirpath, ignore=None):
+        # Use (and fill) the cache, which should be cheaper still
+        files = nbytes = 0
+        pending = [dirpath]
+        while pending:
+            dirpath = pending.pop()
+            for item in self.list(dirpath):
+                path = os.path.join(dirpath, item.name)
+                if ignore and ignore.match(path, item.name, item.is_dir):
+                    continue
+                if item.is_dir and not item.target:
+                    pending.append(path)
+                else:
+                    files += 1
+                    nbytes += item.size
+        return files, nbytes
+
+    def close(self):
+        data = CACHE_MAGIC + zlib.compress(marshal.dumps(self.cache))
+        temp = self.filename + '.tmp'
+        with open(temp, 'wb') as fd:
+            fd.write(data)
+        os.replace(temp, self.filename)
+
+
+class ParallelLister(Lister):
+    """List directories in a pool of threads, ahead of being asked for them.
+
+    The directories we've been told about are listed in the order they will
+    be wanted, so the next one needed is always the first one started.
+    """
+
+    def __init__(self, jobs, stats=None):
+        super().__init__(stats)
+        self.queue = queue.PriorityQueue()
+        self.futures = {}
+        self.threads = []
+        for _ in range(jobs):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            position, dirpath, future = self.queue.get()
+            if future is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                # Each listing counts for itself, and list() adds that up
+                # when it's wanted, so the threads don't share a Stats
+                stats = Stats() if self.stats else None
+                future.set_result((list_dir(dirpath, stats), stats))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+    def prefetch(self, wanted):
+        for position, dirpath in wanted:
+            future = Future()
+            self.futures[dirpath] = future
+            self.queue.put((position, dirpath, future))
+
+    def list(self, dirpath):
+        future = self.futures.pop(dirpath, None)
+        if future is None:
+            return super().list(dirpath)
+        items, stats = future.result()
+        if stats:
+            self.stats.add(stats)
+        return items
+
+    def close(self):
+        for future in self.futures.values():
+            future.cancel()
+        for _ in self.threads:
+            # An empty position sorts before any other, so this is seen next
+            self.queue.put(((), None, None))
+        for thread in self.threads:
+            thread.join()
+
+
+def _glob_to_regex(pattern):
+    """Translate a glob pattern, as used in a .gitignore file, to a regex.
+
+    '*' and '?' do not match '/', but '**' does, and '**/' matches any
+    number of directories (including none).
+    """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 2
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 1
+        elif c == '*':
+            parts.append('[^/]*')
+        elif c == '?':
+            parts.append('[^/]')
+        elif c == '[' and ']' in pattern[i+2:]:
+            end = pattern.index(']', i+2)
+            chars = pattern[i+1:end]
+            if chars[0] == '!':
+                chars = '^' + chars[1:]
+            parts.append('[%s]' % chars.replace('\\', '\\\\'))
+            i = end
+        elif c == '\\' and i+1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return ''.join(parts)
+
+
+class Rules:
+    """A set of patterns, as in a .gitignore file, for paths below 'top'.
+
+    * A pattern with no '/' in it (except at the end) matches a name at
+      any depth. Otherwise it matches a path relative to 'top'.
+    * A pattern ending in '/' only matches directories.
+    * A pattern starting with '!' means anything it matches is excluded,
+      even if other patterns match it (regardless of their order, which
+      is simpler than git).
+
+    The patterns are compiled so that the cost of match() doesn't grow
+    with the number of them: a plain name goes into a set, '*<suffix>' into
+    a tuple for str.endswith(), any other pattern for a name into a single
+    regular expression, and the patterns for paths into a regular expression
+    for each different first directory.
+    """
+
+    def __init__(self, top, patterns=()):
+        self.prefix = top if top.endswith(os.sep) else top + os.sep
+        # Each of these is indexed by whether it is only for directories
+        names = (set(), set())
+        suffixes = (set(), set())
+        name_regexes = []
+        path_regexes = {}
+        excluded = []
+        for pattern in patterns:
+            negated = pattern.startswith('!')
+            if negated:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            if not pattern:
+                continue
+            anchored = '/' in pattern
+            pattern = pattern.lstrip('/')
+            regex = _glob_to_regex(pattern) + ('/' if dir_only else '/?')
+            if negated:
+                excluded.append(regex if anchored else '(?:.*/)?' + regex)
+            elif anchored:
+                first = pattern.split('/', 1)[0]
+                if _is_glob(first):
+                    first = None
+                path_regexes.setdefault(first, []).append(regex)
+            elif not _is_glob(pattern):
+                names[dir_only].add(pattern)
+            elif pattern.startswith('*') and not _is_glob(pattern[1:]):
+                suffixes[dir_only].add(pattern[1:])
+            else:
+                name_regexes.append(regex)
+        self.names, self.dir_names = names
+        self.suffixes, self.dir_suffixes = (tuple(s) for s in suffixes)
+        self.name_regex = _compile(name_regexes)
+        self.path_regexes = {first: _compile(regexes)
+                             for first, regexes in path_regexes.items()}
+        self.excluded = _compile(excluded)
+        self.empty = not (self.names or self.dir_names or self.suffixes or
+                          self.dir_suffixes or self.name_regex or
+                          self.path_regexes)
+
+    def _match_path(self, path, is_dir):
+        relpath = path[len(self.prefix):] + ('/' if is_dir else '')
+        for first in (relpath.split('/', 1)[0], None):
+            regex = self.path_regexes.get(first)
+            if regex and regex.fullmatch(relpath):
+                return True
+        return False
+
+    def match(self, path, name, is_dir):
+        """Does 'path' (whose last component is 'name') match our patterns?
+        """
+        if self.empty:
+            return False
+        matched = (
+            name in self.names or name.endswith(self.suffixes) or
+            (is_dir and (name in self.dir_names or
+                         name.endswith(self.dir_suffixes))) or
+            (self.name_regex is not None and
+             self.name_regex.fullmatch(name + ('/' if is_dir else ''))) or
+            (self.path_regexes and self._match_path(path, is_dir)))
+        if matched and self.excluded:
+            relpath = path[len(self.prefix):] + ('/' if is_dir else '')
+            return self.excluded.fullmatch(relpath) is None
+        return bool(matched)
+
+
+def _is_glob(pattern):
+    return any(c in pattern for c in '*?[\\')
+
+
+def _compile(regexes):
+    if regexes:
+        return re.compile('|'.join(regexes))
+    return None
+
+
+def read_rules(filename):
+    """Return the patterns in a .gitignore style file.
+    """
+    patterns = []
+    with open(filename) as fd:
+        for line in fd:
+            line = line.rstrip('\n').rstrip(' ')
+            if line and not line.startswith('#'):
+                patterns.append(line)
+    return patterns
+
+
+def human(nbytes):
+    """Return a short string for a number of bytes, such as '1.5M'.
+    """
+    for unit in ('', 'K', 'M', 'G', 'T'):
+        if nbytes < 1024 or unit == 'T':
+            break
+        nbytes /= 1024.0
+    if unit:
+        return '%.1f%s' % (nbytes, unit)
+    return '%d' % nbytes
+
+
+def descend(item, path, fold, ancestors=()):
+    """Should we show the contents of this Item (which is at 'path')?
+
+    'fold' is the Rules for folded directories, and 'ancestors' is as for
+    tree(). It is assumed the item is not ignored.
+    """
+    if not item.is_dir:
+        return False
+    if fold and fold.match(path, item.name, True):
+        return False
+    return item.target not in ancestors
+
+
+def itemflags(item, path, fold=None):
+    """Return what filestr() would put after the name of an Item.
+    """
+    # Only a "real" directory has flags of just '/' - a link to a
+    # directory is not marked as folded
+    if item.flags == '/' and fold and fold.match(path, item.name, True):
+        return '/...'
+    return item.flags
+
+
+def itemstr(item, path, fold=None):
+    """Return the representation of an Item, as filestr() would.
+    """
+    return item.name + itemflags(item, path, fold)
+
+
+def tree(dirpath, padding='', fold=None, just_ascii=False, only_dirs=False,
+         lister=None, position=(), ancestors=None, ignore=None,
+         max_depth=None, summary=False):
+    """Print the tree of files below 'dirpath'.
+
+    'fold' and 'ignore' are the Rules for directories whose content is not
+    to be shown, and for things that are not to be shown at all.
+
+    If 'max_depth' is given, only that many levels are shown, and if
+    'summary' is also true, the directories at the last level are shown
+    with the totals from Lister.summarise().
+
+    'lister' is the Lister to use to find out what is in each directory,
+    and 'position' is where 'dirpath' comes in the output (see
+    Lister.prefetch).
+
+    'ancestors' is a tuple of the real paths of the directories we are
+    within, ending with 'dirpath' itself. We use it to avoid following a
+    link back into one of them, which would otherwise go round and round
+    until the path got too long.
+    """
+    if lister is None:
+        lister = Lister()
+    if ancestors is None:
+        ancestors = (os.path.realpath(dirpath),)
 
     if just_ascii:
         if True:            # Follow how Unix 'tree' does it
@@ -96,57 +807,219 @@ def tree(dirpath, padding='', fold_dirs=None, just_ascii=False, only_dirs=False)
         B = '│ '
         S = '  '
 
-    filenames = sorted(os.listdir(dirpath))
-    for count, name in enumerate(filenames):
-        path = os.path.join(dirpath, name)
-        if os.path.isdir(path):
+    def shown(item, path):
+        if only_dirs and not item.is_dir:
+            return False
+        return not (ignore and ignore.match(path, item.name, item.is_dir))
 
-            # TODO Really, we should have this switchable
-            if name in DEFAULT_IGNORE:
-                continue
+    # The depth of our content is one more than our own
+    deeper = max_depth is None or len(position) + 1 < max_depth
 
-            if count+1 == len(filenames):
-                new_padding = padding + L
-            else:
-                new_padding = padding + T
-            print(new_padding + filestr(path, name, fold_dirs))
+    items = lister.list(dirpath)
+    if deeper:
+        lister.prefetch((position + (count,), path)
+                        for count, item, path in with_paths(dirpath, items)
+                        if shown(item, path)
+                        and descend(item, path, fold, ancestors))
+    visible = ((count, item, path)
+               for count, item, path in with_paths(dirpath, items)
+               if shown(item, path))
+    for (count, item, path), last in lookahead(visible):
+        text = itemstr(item, path, fold)
+        if not deeper:
+            if summary and descend(item, path, fold, ancestors):
+                files, nbytes = lister.summarise(path, ignore)
+                text += ' [%d file%s, %s]' % (files, '' if files == 1 else 's',
+                                              human(nbytes))
+        if last:
+            print(padding + L + text)
+        else:
+            print(padding + T + text)
 
-            if fold_dirs and name in fold_dirs:
-                continue
+        if not deeper or not descend(item, path, fold, ancestors):
+            continue
 
-            if count+1 == len(filenames):
-                new_padding = padding + S
-            else:
-                new_padding = padding + B
-            tree(path, new_padding, fold_dirs=fold_dirs, just_ascii=just_ascii, only_dirs=only_dirs)
-        elif only_dirs:
+        if last:
+            new_padding = padding + S
+        else:
+            new_padding = padding + B
+        real = item.target or os.path.join(ancestors[-1], item.name)
+        tree(path, new_padding, fold=fold, just_ascii=just_ascii,
+             only_dirs=only_dirs, lister=lister, position=position + (count,),
+             ancestors=ancestors + (real,), ignore=ignore,
+             max_depth=max_depth, summary=summary)
+
+
+def walk(dirpath, emit, fold=None, only_dirs=False, lister=None,
+         position=(), ancestors=None, ignore=None, max_depth=None):
+    """Report on everything below 'dirpath', and return its totals.
+
+    For each entry, calls::
+
+        emit(path, type, flags, size, files, nbytes)
+
+    as described for '-json' in the module docstring, with 'files' and
+    'nbytes' as None for anything but a directory (or link to one). A
+    directory is reported after its contents. If 'only_dirs' is true, then
+    only directories are reported, but the totals still count everything
+    that isn't ignored. If 'max_depth' is given, only that many levels are
+    reported, and the totals for the directories at the last level come
+    from Lister.summarise().
+
+    The other arguments are as for tree(). Returns (files, nbytes) for
+    'dirpath' itself.
+    """
+    if lister is None:
+        lister = Lister()
+    if ancestors is None:
+        ancestors = (os.path.realpath(dirpath),)
+
+    def ignored(item, path):
+        return ignore and ignore.match(path, item.name, item.is_dir)
+
+    deeper = max_depth is None or len(position) + 1 < max_depth
+
+    files = nbytes = 0
+    items = lister.list(dirpath)
+    if deeper:
+        lister.prefetch((position + (count,), path)
+                        for count, item, path in with_paths(dirpath, items)
+                        if not ignored(item, path)
+                        and descend(item, path, fold, ancestors))
+    for count, item, path in with_paths(dirpath, items):
+        if ignored(item, path):
             continue
+        if not descend(item, path, fold, ancestors):
+            sub_files = sub_bytes = None
+        elif deeper:
+            real = item.target or os.path.join(ancestors[-1], item.name)
+            sub_files, sub_bytes = walk(
+                path, emit, fold=fold, only_dirs=only_dirs, lister=lister,
+                position=position + (count,), ancestors=ancestors + (real,),
+                ignore=ignore, max_depth=max_depth)
         else:
-            if count+1 == len(filenames):
-                new_padding = padding + L
-            else:
-                new_padding = padding + T
-            print(new_padding + filestr(path, name, fold_dirs))
+            sub_files, sub_bytes = lister.summarise(path, ignore)
+
+        if item.target:
+            kind = 'link'
+            files += 1
+            nbytes += item.size
+        elif item.is_dir:
+            kind = 'dir'
+            if sub_files is not None:
+                files += sub_files
+                nbytes += sub_bytes
+        else:
+            kind = 'file'
+            files += 1
+            nbytes += item.size
+        if item.is_dir or not only_dirs:
+            emit(path, kind, itemflags(item, path, fold), item.size,
+                 sub_files, sub_bytes)
+    return files, nbytes
+
+
+def emit_json(path, kind, flags, size, files, nbytes):
+    print(json.dumps({'path': path, 'type': kind, 'flags': flags,
+                      'size': size, 'files': files, 'bytes': nbytes}))
+
+
+def emit_nul(path, kind, flags, size, files, nbytes):
+    fields = (path, kind, flags, size, files, nbytes)
+    sys.stdout.buffer.write(b''.join(
+        (b'' if value is None else os.fsencode(str(value))) + b'\0'
+        for value in fields))
 
 
 def main(args):
 
     where = None
     just_ascii = False
-    fold_dirs = []
+    fold = list(DEFAULT_FOLD)
+    ignore = list(DEFAULT_IGNORE)
+    nofold = set()
+    noignore = set()
     only_dirs = False
+    stats = None
+    jobs = 1
+    unsorted = False
+    run_size = None
+    cache_file = None
+    refresh = False
+    emit = None
+    max_depth = None
+    summary = False
 
     while args:
         word = args.pop(0)
         if word in ('-h', '-help', '--help'):
             print(__doc__)
             return
-        elif word in ('-f', '-fold'):
-            fold_dirs.append(args.pop(0))
+        elif word in ('-f', '-fold', '--fold'):
+            fold.append(args.pop(0))
+        elif word in ('-i', '-ignore', '--ignore'):
+            ignore.append(args.pop(0))
+        elif word == '-nofold':
+            nofold.add(args.pop(0).rstrip('/'))
+        elif word == '-noignore':
+            noignore.add(args.pop(0).rstrip('/'))
+        elif word in ('-fold-file', '-ignore-file'):
+            filename = args.pop(0)
+            try:
+                patterns = read_rules(filename)
+            except OSError as exc:
+                print('Cannot read %s: %s' % (filename, exc))
+                return
+            if word == '-fold-file':
+                fold.extend(patterns)
+            else:
+                ignore.extend(patterns)
         elif word in ('-a', '-ascii'):
             just_ascii = True
         elif word == '-d':
             only_dirs = True
+        elif word == '-L':
+            try:
+                max_depth = int(args.pop(0))
+            except (IndexError, ValueError):
+                print('-L needs a depth')
+                return
+            if max_depth < 1:
+                print('-L needs a depth of at least 1')
+                return
+        elif word in ('-summarise', '-summarize'):
+            summary = True
+        elif word == '-j':
+            try:
+                jobs = int(args.pop(0))
+            except (IndexError, ValueError):
+                print('-j needs a number of threads')
+                return
+        elif word in ('-U', '-unsorted'):
+            unsorted = True
+        elif word == '-spill':
+            try:
+                run_size = int(args.pop(0))
+            except (IndexError, ValueError):
+                print('-spill needs a number of entries')
+                return
+            if run_size < 1:
+                print('-spill needs a number of entries of at least 1')
+                return
+        elif word == '-cache':
+            try:
+                cache_file = args.pop(0)
+            except IndexError:
+                print('-cache needs a filename')
+                return
+        elif word == '-refresh':
+            refresh = True
+        elif word == '-json':
+            emit = emit_json
+        elif word in ('-0', '-nul'):
+            emit = emit_nul
+        elif word in ('-stats', '--stats'):
+            stats = Stats()
         elif where is None:
             where = word
         else:
@@ -155,13 +1028,49 @@ def main(args):
     if where is None:
         where = '.'
 
-    # TODO This is a hack - it should be optional
-    if '.git' not in fold_dirs:
-        fold_dirs.append('.git')
+    if unsorted and run_size:
+        print('Cannot use both -unsorted and -spill')
+        return
+    if jobs > 1 and (unsorted or run_size):
+        print('Cannot use -j with -unsorted or -spill')
+        return
+    if cache_file and (jobs > 1 or unsorted or run_size):
+        print('Cannot use -cache with -j, -unsorted or -spill')
+        return
+    if summary and not max_depth:
+        print('-summarise only makes sense with -L')
+        return
+    if refresh and not cache_file:
+        print('-refresh only makes sense with -cache')
+        return
 
     path = os.path.abspath(where)
-    print(filestr(path, os.path.basename(path)))
-    tree(path, fold_dirs=fold_dirs, just_ascii=just_ascii, only_dirs=only_dirs)
+    fold = Rules(path, [p for p in fold if p.rstrip('/') not in nofold])
+    ignore = Rules(path, [p for p in ignore if p.rstrip('/') not in noignore])
+    if not emit:
+        print(filestr(path, os.path.basename(path)))
+    if jobs > 1:
+        lister = ParallelLister(jobs, stats)
+    elif unsorted or run_size:
+        lister = StreamingLister(run_size, stats)
+    elif cache_file:
+        lister = CachingLister(cache_file, refresh, stats)
+    else:
+        lister = Lister(stats)
+    try:
+        if emit:
+            files, nbytes = walk(path, emit, fold=fold, only_dirs=only_dirs,
+                                 lister=lister, ignore=ignore,
+                                 max_depth=max_depth)
+            emit(path, 'dir', '/', None, files, nbytes)
+        else:
+            tree(path, fold=fold, just_ascii=just_ascii, only_dirs=only_dirs,
+                 lister=lister, ignore=ignore, max_depth=max_depth,
+                 summary=summary)
+    finally:
+        lister.close()
+    if stats:
+        stats.report()
 
 
 if __name__ == '__main__':